@@ -0,0 +1,264 @@
+"""Measure what prociolog costs over a plain :class:`subprocess.Popen`.
+
+Each case runs a small generator child (see :data:`CHILDREN`) through one of
+the drivers (see :data:`DRIVERS`) at one logging level. Every case runs in a
+fresh worker process so that its peak RSS and CPU time are its own; results
+are printed as a table and may be written as JSON for later comparison::
+
+    $ python bench.py -o before.json
+    $ python bench.py -o after.json --compare before.json
+
+Run ``python bench.py --help`` for the other options.
+"""
+
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from subprocess import PIPE, Popen
+
+import prociolog
+
+CHILDREN = {
+    # A yes(1)-style flood of short lines.
+    "flood": (
+        "import os, sys\n"
+        "size = int(sys.argv[1])\n"
+        "chunk = b'y\\n' * 32768\n"
+        "out = sys.stdout.fileno()\n"
+        "while size > 0:\n"
+        "    size -= os.write(out, chunk[:size])\n"
+    ),
+    # Incompressible binary data with the odd newline.
+    "blob": (
+        "import os, sys\n"
+        "size = int(sys.argv[1])\n"
+        "chunk = os.urandom(65536)\n"
+        "out = sys.stdout.fileno()\n"
+        "while size > 0:\n"
+        "    size -= os.write(out, chunk[:size])\n"
+    ),
+    # Many tiny lines, written one at a time.
+    "tiny": (
+        "import sys\n"
+        "write = sys.stdout.write\n"
+        "for i in range(int(sys.argv[1]) // 8):\n"
+        "    write('%07d\\n' % (i % 10000000))\n"
+    ),
+    # A request/response loop: echo each line from stdin.
+    "interactive": (
+        "import sys\n"
+        "while True:\n"
+        "    line = sys.stdin.readline()\n"
+        "    if not line:\n"
+        "        break\n"
+        "    sys.stdout.write(line)\n"
+        "    sys.stdout.flush()\n"
+    ),
+}
+"""Child programs; each takes the number of bytes to produce as an argument."""
+
+SIZES = {
+    "flood": 32 << 20,
+    "blob": 32 << 20,
+    "tiny": 4 << 20,
+    "interactive": 2000,
+}
+"""Default sizes (in bytes, or round trips for "interactive")."""
+
+DRIVERS = ("popen", "loggingfile", "lineloggingfile", "rawio")
+"""Ways of running a child: plain Popen or LoggingCmd with a wrapper ("rawio"
+is a LineLoggingFile under buffered file objects, see LoggingCmd.rawio)."""
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+}
+"""Logger levels: "debug" logs (and formats) every record, "info" none."""
+
+def command(child, size):
+    return [sys.executable, "-c", CHILDREN[child], str(size)]
+
+def logger(level):
+    """Return a logger whose records are formatted and thrown away."""
+    logger = logging.getLogger("bench")
+    logger.setLevel(LEVELS[level])
+    logger.propagate = False
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    logger.handlers = [handler]
+    for fdname in prociolog.LoggingCmd.fdnames:
+        logging.getLogger("bench." + fdname).setLevel(LEVELS[level])
+    return logger
+
+def spawn(driver, args, level):
+    if driver == "popen":
+        return Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    class Cmd(prociolog.LoggingCmd):
+        wrapper = {
+            "loggingfile": prociolog.LoggingFile,
+            "lineloggingfile": prociolog.LineLoggingFile,
+            "rawio": prociolog.LineLoggingFile,
+        }[driver]
+        rawio = driver == "rawio"
+    return Cmd(args, logger(level))
+
+def stream(driver, child, size, level):
+    """Read everything the child writes; return (bytes, chunks, latencies)."""
+    proc = spawn(driver, command(child, size), level)
+    proc.stdin.close()
+    total = chunks = 0
+    latencies = []
+    while True:
+        start = time.time()
+        data = proc.stdout.read(65536)
+        latencies.append(time.time() - start)
+        if not data:
+            break
+        total += len(data)
+        chunks += 1
+    proc.stdout.close()
+    proc.wait()
+    return total, chunks, latencies
+
+def interactive(driver, child, size, level):
+    """Make *size* round trips; return (bytes, round trips, latencies)."""
+    proc = spawn(driver, command(child, size), level)
+    request = b"ping\n"
+    total = 0
+    latencies = []
+    for i in range(size):
+        start = time.time()
+        proc.stdin.write(request)
+        proc.stdin.flush()
+        response = proc.stdout.readline()
+        latencies.append(time.time() - start)
+        total += len(response)
+    proc.stdin.close()
+    proc.stdout.read()
+    proc.wait()
+    return total, size, latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(driver, child, size, level):
+    """Run one case in this process and return its results."""
+    func = interactive if child == "interactive" else stream
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    total, chunks, latencies = func(driver, child, size, level)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    maxrss = after.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return dict(
+        driver=driver, child=child, size=size, level=level,
+        bytes=total, chunks=chunks, seconds=elapsed,
+        throughput=total / elapsed if elapsed else 0.0,
+        latency_mean=sum(latencies) / len(latencies) if latencies else 0.0,
+        latency_p50=percentile(latencies, 0.5) if latencies else 0.0,
+        latency_p99=percentile(latencies, 0.99) if latencies else 0.0,
+        cpu_user=after.ru_utime - before.ru_utime,
+        cpu_system=after.ru_stime - before.ru_stime,
+        maxrss=maxrss,
+    )
+
+def runworker(driver, child, size, level):
+    """Run one case in a fresh worker process and return its results."""
+    args = [sys.executable, os.path.abspath(__file__), "--worker",
+        driver, child, str(size), level]
+    output = subprocess.check_output(args)
+    return json.loads(output.decode("utf-8"))
+
+def key(result):
+    return (result["child"], result["driver"], result["level"])
+
+def report(results, baseline=None, out=sys.stdout):
+    """Print *results* as a table, with ratios to *baseline* if given."""
+    baseline = dict((key(r), r) for r in baseline or [])
+    popen = dict((r["child"], r) for r in results if r["driver"] == "popen")
+    header = "%-12s %-16s %-6s %10s %9s %10s %10s %8s %9s" % (
+        "child", "driver", "level", "MB/s", "vs popen", "p50 us", "p99 us",
+        "cpu s", "rss MB")
+    if baseline:
+        header += " %9s" % "vs base"
+    out.write(header + "\n")
+    for result in results:
+        raw = popen.get(result["child"])
+        overhead = result["seconds"] / raw["seconds"] if raw else float("nan")
+        line = "%-12s %-16s %-6s %10.1f %8.2fx %10.1f %10.1f %8.2f %9.1f" % (
+            result["child"], result["driver"], result["level"],
+            result["throughput"] / 1e6, overhead,
+            result["latency_p50"] * 1e6, result["latency_p99"] * 1e6,
+            result["cpu_user"] + result["cpu_system"], result["maxrss"] / 1e6)
+        if baseline:
+            base = baseline.get(key(result))
+            ratio = result["seconds"] / base["seconds"] if base else float("nan")
+            line += " %8.2fx" % ratio
+        out.write(line + "\n")
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--worker", nargs=4, metavar=("DRIVER", "CHILD", "SIZE", "LEVEL"),
+        help=argparse.SUPPRESS)
+    parser.add_argument("-c", "--child", action="append", choices=sorted(CHILDREN),
+        help="child to run (repeatable; default: all)")
+    parser.add_argument("-d", "--driver", action="append", choices=DRIVERS,
+        help="driver to use (repeatable; default: all)")
+    parser.add_argument("-l", "--level", action="append", choices=sorted(LEVELS),
+        help="logger level (repeatable; default: all)")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+        help="multiply the default sizes by SCALE")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+        help="keep the fastest of REPEAT runs of each case")
+    parser.add_argument("-o", "--output", help="write results as JSON to OUTPUT")
+    parser.add_argument("--compare", help="compare with results in a JSON file")
+    options = parser.parse_args(argv)
+
+    if options.worker:
+        driver, child, size, level = options.worker
+        json.dump(run(driver, child, int(size), level), sys.stdout)
+        return 0
+
+    results = []
+    for child in options.child or sorted(CHILDREN):
+        size = max(1, int(SIZES[child] * options.scale))
+        for driver in options.driver or DRIVERS:
+            for level in options.level or sorted(LEVELS):
+                if driver == "popen" and level != "debug":
+                    # Plain Popen doesn't log, so the level doesn't matter.
+                    level = "debug"
+                    if any(key(r) == (child, driver, level) for r in results):
+                        continue
+                runs = [runworker(driver, child, size, level)
+                    for i in range(options.repeat)]
+                results.append(min(runs, key=lambda r: r["seconds"]))
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(dict(
+                python=sys.version.split()[0],
+                platform=platform.platform(),
+                time=time.time(),
+                results=results,
+            ), f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
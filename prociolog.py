@@ -1,67 +1,1153 @@
+import asyncio
+import atexit
+import bisect
+import codecs
+import collections
+import errno
+import hashlib
+import io
 import logging
+import mmap
+import os
+import re
+import select
+import selectors
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
 
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, SubprocessError, TimeoutExpired
 
 try:
-    NullHandler = logging.NullHandler
-except AttributeError:
-    class NullHandler(logging.Handler):
-        def emit(self, record): pass
+    import zstandard
+except ImportError:
+    zstandard = None
 
-__all__ = ["LoggingFile", "LineLoggingFile", "LoggingCmd", "wrapfd"]
+_subscribelock = threading.Lock()
+
+_strtypes = (str, bytes, bytearray)
+
+__all__ = ["ArchiveHandler", "ArchiveReader", "AsyncLoggingCmd",
+    "AsyncLoggingFile", "CaptureHandler", "CaptureReader", "CaptureRecord",
+    "Dispatcher", "HeadPolicy", "LazyPreview", "LazyRepr", "LazyText",
+    "LineBatch", "LineBuffer", "LoggingFile", "CmdResult", "LoggingCmdPool",
+    "RateLimitPolicy", "RingBuffer", "RuleSet", "SamplePolicy",
+    "LoggingRawIO", "StreamMetrics", "Subscription", "Transcript", "TranscriptEntry",
+    "formatmetrics", "writemetrics",
+    "childlogger", "clearcache", "run_many",
+    "LineLoggingFile", "LoggingCmd", "wrapfd", "wrapraw"]
 
 LOGGER = "cmdlog"
 
 log = logging.getLogger(LOGGER)
-log.addHandler(NullHandler())
+log.addHandler(logging.NullHandler())
+
+class LazyRepr(object):
+    """Defer the :func:`repr` of intercepted data until it is formatted.
+
+    Instances are passed to the logger as the record's message; the (possibly
+    large) representation is only built when a handler actually formats the
+    record.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return repr(data)
+
+    __repr__ = __str__
+
+    def snapshot(self):
+        """Return a copy that does not refer to any mutable buffers."""
+        return type(self)(_snapshot(self.data))
+
+class LazyPreview(LazyRepr):
+    """Defer the :func:`repr` of the ends of truncated data.
+
+    *head* and *tail* are the beginning and end of the original data (for byte
+    strings, they are :class:`memoryview` slices of it, so the data is not
+    copied). They are rendered like "'head' ... 'tail'"; *data* is *head*.
+    """
+    __slots__ = ("tail",)
+
+    def __init__(self, head, tail):
+        LazyRepr.__init__(self, head)
+        self.tail = tail
+
+    def __str__(self):
+        return "%s ... %s" % (LazyRepr(self.data), LazyRepr(self.tail))
+
+    __repr__ = __str__
+
+    def snapshot(self):
+        return type(self)(_snapshot(self.data), _snapshot(self.tail))
+
+class LazyText(LazyRepr):
+    """Defer decoding intercepted data until it is formatted.
+
+    Byte strings are decoded with *encoding* and *errors*; if *encoding* is
+    None, *data* is already text. Either way, the text is rendered as it is,
+    without a trailing newline, rather than as a :func:`repr`.
+    """
+    __slots__ = ("encoding", "errors")
+
+    def __init__(self, data, encoding=None, errors="strict"):
+        LazyRepr.__init__(self, data)
+        self.encoding = encoding
+        self.errors = errors
+
+    def text(self):
+        """Return the decoded data."""
+        data = self.data
+        if self.encoding is not None:
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            data = data.decode(self.encoding, self.errors)
+        return data.rstrip("\r\n")
+
+    __str__ = __repr__ = text
+
+    def snapshot(self):
+        return type(self)(_snapshot(self.data), self.encoding, self.errors)
+
+def clearcache():
+    """Forget cached child loggers (see :func:`childlogger`)."""
+    _childloggers.clear()
+
+def _log(logger, level, msg, args=(), kwargs=None):
+    """Log a record without looking up the caller.
+
+    :class:`logging.Logger` instances get a record built by their
+    *makeRecord* method and passed straight to *handle*, skipping the stack
+    walk that :meth:`logging.Logger.log` does to find the caller (which would
+    only ever find this module). Like *log*, nothing is done if the logger
+    is not enabled for *level*. Other loggers, and calls that ask for
+    *exc_info* or stack information, go through *log* as usual.
+    """
+    kwargs = kwargs or {}
+    if not isinstance(logger, logging.Logger) or len(kwargs) > ("extra" in kwargs):
+        logger.log(level, msg, *args, **kwargs)
+        return
+    elif not logger.isEnabledFor(level):
+        return
+    record = logger.makeRecord(logger.name, level, "(unknown file)", 0, msg,
+        args, None, "(unknown function)", kwargs.get("extra"))
+    logger.handle(record)
+
+def _tobytes(data):
+    """Return *data* as bytes, encoding text as UTF-8."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return data.encode("utf-8")
+
+def _totext(data):
+    """Return *data* as text, decoding bytes as UTF-8."""
+    if isinstance(data, bytes):
+        return data.decode("utf-8")
+    return data
+
+def _snapshot(data):
+    """Return an immutable copy of *data* if it is backed by a mutable buffer."""
+    if isinstance(data, bytearray):
+        return bytes(data)
+    elif isinstance(data, memoryview) and not data.readonly:
+        return data.tobytes()
+    return data
+
+class Dispatcher(object):
+    """Emit log records from a background thread.
+
+    Records are put on a bounded queue and passed to their loggers by a
+    dedicated thread, so a slow handler does not hold up the IO that produced
+    them. When the queue is full, *policy* decides what happens:
+
+        * "block" waits for the dispatcher thread to make room;
+        * "drop-oldest" discards the oldest queued record; and
+        * "sample" keeps one of every *samplerate* new records (displacing the
+          oldest queued record) and discards the rest.
+
+    Parameters are:
+
+        * *maxsize* the number of records that may be queued;
+        * *policy* one of :attr:`policies`; and
+        * *samplerate* used by the "sample" policy.
+
+    The thread is started when the first record is put on the queue and runs
+    until :meth:`close` is called (or the interpreter exits), so a dispatcher
+    is meant to be long-lived and shared by many wrappers. The *queued*,
+    *emitted*, *dropped* and *errors* attributes count records put on the queue,
+    passed to their loggers, discarded because the queue was full and whose
+    logger raised an exception, respectively.
+    """
+    policies = ("block", "drop-oldest", "sample")
+    """Valid backpressure policies."""
+
+    def __init__(self, maxsize=10000, policy="block", samplerate=10):
+        if policy not in self.policies:
+            raise ValueError("unknown policy: %r" % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.samplerate = samplerate
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.unfinished = 0
+        self.overflows = 0
+        self.queued = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def put(self, logger, level, msg, args=(), kwargs=None):
+        """Queue a call to *logger*'s :meth:`logging.Logger.log` method.
+
+        Raises :exc:`ValueError` if the dispatcher is closed, even while
+        waiting for room on the queue.
+        """
+        with self.cond:
+            if self.closed:
+                raise ValueError("dispatcher is closed")
+            if self.thread is None:
+                self.start()
+            while len(self.queue) >= self.maxsize:
+                if self.policy == "block":
+                    self.cond.wait()
+                    if self.closed:
+                        # The thread may already be gone.
+                        raise ValueError("dispatcher is closed")
+                    continue
+                elif self.policy == "sample":
+                    self.overflows += 1
+                    if self.overflows % self.samplerate:
+                        self.dropped += 1
+                        return
+                self.queue.popleft()
+                self.unfinished -= 1
+                self.dropped += 1
+            self.queue.append((logger, level, msg, args, kwargs or {}))
+            self.unfinished += 1
+            self.queued += 1
+            self.cond.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="prociolog-dispatcher")
+        self.thread.daemon = True
+        self.thread.start()
+        _dispatchers.add(self)
+
+    def run(self):
+        """Pass queued records to their loggers until closed."""
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                logger, level, msg, args, kwargs = self.queue.popleft()
+                self.cond.notify_all()
+            try:
+                _log(logger, level, msg, args, kwargs)
+            except Exception:
+                with self.cond:
+                    self.errors += 1
+            with self.cond:
+                self.unfinished -= 1
+                self.emitted += 1
+                self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued record has been emitted.
+
+        Returns False if *timeout* seconds pass first.
+        """
+        endtime = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.unfinished:
+                if endtime is None:
+                    self.cond.wait()
+                    continue
+                remaining = endtime - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self):
+        """Emit the records left on the queue and stop the thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+_dispatchers = weakref.WeakSet()
+
+@atexit.register
+def _closedispatchers():
+    """Close the dispatchers whose threads are still running."""
+    for dispatcher in list(_dispatchers):
+        dispatcher.close()
+
+class SamplePolicy(object):
+    """Allow one of every *n* records, starting with the first."""
+
+    def __init__(self, n):
+        self.n = n
+        self.seen = 0
+
+    def allow(self, data):
+        self.seen += 1
+        return (self.seen - 1) % self.n == 0
+
+class RateLimitPolicy(object):
+    """Allow up to *rate* records per second.
+
+    This is a token bucket holding up to *burst* tokens (by default, *rate*);
+    each record takes a token and the bucket is refilled at *rate* tokens per
+    second as measured by *clock*.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def allow(self, data):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class HeadPolicy(object):
+    """Allow the first *first* records, then one of every *every* (if given)."""
+
+    def __init__(self, first, every=None):
+        self.first = first
+        self.every = every
+        self.seen = 0
+
+    def allow(self, data):
+        self.seen += 1
+        if self.seen <= self.first:
+            return True
+        elif self.every is None:
+            return False
+        return (self.seen - self.first) % self.every == 0
+
+class StreamMetrics(object):
+    """Counters for the IO through one wrapper.
+
+    Counts are kept for each direction ("read" and "write"): *reads* and
+    *writes* count calls, *readbytes*/*writebytes* the length of the data and
+    *readlines*/*writelines* the newlines in it (for a
+    :class:`LineLoggingFile`; other wrappers don't count lines). *logtime* and
+    *maxlogtime* are the total and longest time spent logging data;
+    *buffered* and *maxbuffered* the current and largest length of the
+    partial lines held by a :class:`LineLoggingFile`. *delay* and *maxdelay*
+    are the total and longest time between a pipe becoming readable and
+    :meth:`LoggingCmd.pump` reading it, which is as close as we can get to the
+    time from the child's write to our read. Times are in seconds, as
+    measured by *clock*.
+    """
+    __slots__ = ("clock", "started", "finished", "reads", "readbytes",
+        "readlines", "writes", "writebytes", "writelines", "logtime",
+        "maxlogtime", "delay", "maxdelay", "buffered", "maxbuffered")
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.finished = None
+        self.reads = self.readbytes = self.readlines = 0
+        self.writes = self.writebytes = self.writelines = 0
+        self.logtime = self.maxlogtime = 0.0
+        self.delay = self.maxdelay = 0.0
+        self.buffered = self.maxbuffered = 0
+
+    def add(self, direction, size, lines, logtime, buffered=0):
+        """Count *size* bytes and *lines* lines logged in *logtime* seconds.
+
+        *buffered* is the length of the partial line left for *direction*.
+        """
+        if direction == "read":
+            self.reads += 1
+            self.readbytes += size
+            self.readlines += lines
+        else:
+            self.writes += 1
+            self.writebytes += size
+            self.writelines += lines
+        self.logtime += logtime
+        if logtime > self.maxlogtime:
+            self.maxlogtime = logtime
+        self.buffered = buffered
+        if buffered > self.maxbuffered:
+            self.maxbuffered = buffered
+
+    def adddelay(self, delay):
+        """Count *delay* seconds between a pipe becoming readable and its read."""
+        self.delay += delay
+        if delay > self.maxdelay:
+            self.maxdelay = delay
+
+    def close(self):
+        """Stop the clock used for rates."""
+        if self.finished is None:
+            self.finished = self.clock()
+
+    def snapshot(self):
+        """Return the counters (and rates per second) as a dict."""
+        snapshot = dict((name, getattr(self, name)) for name in self.__slots__
+            if name != "clock")
+        end = self.clock() if self.finished is None else self.finished
+        elapsed = snapshot["elapsed"] = end - self.started
+        for name in ("readbytes", "readlines", "writebytes", "writelines"):
+            snapshot[name + "persec"] = snapshot[name] / elapsed if elapsed else 0.0
+        return snapshot
+
+_METRICS = (
+    ("bytes_total", "counter", "Bytes passed through a stream.",
+        (("read", "readbytes"), ("write", "writebytes"))),
+    ("calls_total", "counter", "Reads and writes passed through a stream.",
+        (("read", "reads"), ("write", "writes"))),
+    ("lines_total", "counter", "Newlines passed through a stream.",
+        (("read", "readlines"), ("write", "writelines"))),
+    ("log_seconds_total", "counter", "Time spent logging a stream's data.",
+        ((None, "logtime"),)),
+    ("log_seconds_max", "gauge", "Longest time spent logging a stream's data.",
+        ((None, "maxlogtime"),)),
+    ("read_delay_seconds_total", "counter",
+        "Time between a pipe becoming readable and being read.",
+        ((None, "delay"),)),
+    ("read_delay_seconds_max", "gauge",
+        "Longest time between a pipe becoming readable and being read.",
+        ((None, "maxdelay"),)),
+    ("buffered", "gauge", "Length of the partial lines held for a stream.",
+        ((None, "buffered"),)),
+    ("buffered_max", "gauge", "Largest length of the partial lines held for a stream.",
+        ((None, "maxbuffered"),)),
+)
+
+def _labels(labels):
+    escaped = ("%s=\"%s\"" % (name, str(value).replace("\\", "\\\\")
+        .replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in sorted(labels.items()))
+    return "{%s}" % ",".join(escaped)
+
+def formatmetrics(metrics, prefix="prociolog"):
+    """Return *metrics* in the Prometheus text format.
+
+    *metrics* is a sequence of (labels, :class:`StreamMetrics`) pairs, where
+    labels is a dict (see :meth:`LoggingCmd.streammetrics`).
+    """
+    lines = []
+    for name, kind, help, fields in _METRICS:
+        name = "%s_%s" % (prefix, name)
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, stream in metrics:
+            for direction, field in fields:
+                series = labels
+                if direction is not None:
+                    series = dict(labels, direction=direction)
+                lines.append("%s%s %r" % (name, _labels(series),
+                    float(getattr(stream, field))))
+    return "\n".join(lines) + "\n"
+
+def writemetrics(path, metrics, prefix="prociolog"):
+    """Write :func:`formatmetrics` to *path*.
+
+    The file is replaced atomically, so it can be read at any time (by the
+    Prometheus node exporter's textfile collector, say).
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(formatmetrics(metrics, prefix))
+    os.rename(tmp, path)
+
+class TranscriptEntry(collections.namedtuple("TranscriptEntry",
+        "seq time stream data")):
+    """A chunk of data in a :class:`Transcript`.
+
+    *seq* is the entry's position in the transcript and *time* when it crossed
+    the pipe, as measured by the transcript's *clock*.
+    """
+    __slots__ = ()
+
+class Transcript(object):
+    """An ordered record of the data crossing several streams.
+
+    Wrappers given the same transcript (with the *transcript* option of
+    :class:`LoggingFile`, say through :attr:`LoggingCmd.options`) add each
+    chunk they read or write, stamped with a sequence number and the time, as
+    it crosses the pipe and before any logging is done. Chunks are kept
+    regardless of level and policies, so the transcript shows how the streams
+    were interleaved and how long a process took to respond (see
+    :meth:`latencies`). Parameters are:
+
+        * *logger* if given, entries are also logged to it as one stream, in
+          order, with *seq*, *elapsed* (since the transcript was made) and
+          *stream* extra attributes;
+        * *level* the level of those records;
+        * *maxlen* the number of entries to keep (or None to keep them all);
+          and
+        * *clock* a function returning the time in seconds.
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG, maxlen=None,
+            clock=time.monotonic):
+        self.logger = logger
+        self.level = level
+        self.clock = clock
+        self.entries = collections.deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.started = clock()
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, stream, data):
+        """Add a copy of *data* that crossed *stream*; return its entry.
+
+        Empty strings (like the one read at the end of a stream) are skipped.
+        """
+        if not len(data):
+            return None
+        data = _snapshot(data)
+        with self.lock:
+            entry = TranscriptEntry(self.seq, self.clock(), stream, data)
+            self.seq += 1
+            self.entries.append(entry)
+            if self.logger is not None:
+                _log(self.logger, self.level, LazyRepr(data), (), dict(extra=dict(
+                    seq=entry.seq, elapsed=entry.time - self.started, stream=stream)))
+        return entry
+
+    def latencies(self, request="stdin", response="stdout"):
+        """Generate (request entry, response entry, seconds) tuples.
+
+        Each chunk written to *request* is paired with the first chunk read
+        from *response* after it (later requests written before the response
+        are folded into the first).
+        """
+        pending = None
+        for entry in self:
+            if entry.stream == request:
+                if pending is None:
+                    pending = entry
+            elif entry.stream == response and pending is not None:
+                yield pending, entry, entry.time - pending.time
+                pending = None
+
+def _resolve(future, result=None, error=None):
+    """Complete *future* (from its loop's thread) unless it was cancelled."""
+    if future.cancelled():
+        return
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class Subscription(object):
+    """Chunks of data read or written by wrappers, passed to one consumer.
+
+    Wrappers hand each chunk to their subscriptions (see
+    :meth:`LoggingFile.subscribe` and :meth:`LoggingCmd.subscribe`) as it
+    crosses the pipe, as a (stream, data) pair. *data* is shared by every
+    subscription, so it must not be modified. If *callback* is given, it is
+    called with each pair in the thread that read or wrote it, and must be
+    quick. Otherwise pairs are queued until they are consumed with
+    :meth:`get`, by iterating over the subscription or with ``async for``.
+    The queue holds at most *maxsize* pairs (:attr:`maxsize` by default);
+    when a consumer falls behind, the oldest pairs are dropped and counted
+    in *dropped*, so the wrapped streams never wait for a consumer.
+
+    The subscription is closed (and iteration stops once the queue is
+    empty) when all of its wrappers are closed, or by :meth:`close`.
+    """
+    maxsize = 1024
+    """Number of chunks queued for the consumer before the oldest is dropped."""
+
+    def __init__(self, callback=None, maxsize=None):
+        self.callback = callback
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.waiters = collections.deque()
+        self.sources = 0
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def put(self, stream, data):
+        """Deliver a chunk of *data* from *stream*; never blocks."""
+        if self.callback is not None:
+            self.received += 1
+            try:
+                self.callback(stream, data)
+            except Exception:
+                self.errors += 1
+            return
+        with self.cond:
+            if self.closed:
+                return
+            self.received += 1
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                if not future.cancelled():
+                    loop.call_soon_threadsafe(self.deliver, future, (stream, data))
+                    return
+            if len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((stream, data))
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next (stream, data) pair.
+
+        Returns None if the subscription is closed and empty, or if *timeout*
+        seconds pass first.
+        """
+        endtime = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while not self.queue and not self.closed:
+                if endtime is None:
+                    self.cond.wait()
+                    continue
+                remaining = endtime - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.queue.popleft() if self.queue else None
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if self.queue:
+                return self.queue.popleft()
+            elif self.closed:
+                raise StopAsyncIteration
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            with self.cond:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+            raise
+
+    def deliver(self, future, item):
+        """Complete *future* with *item* in the future's loop.
+
+        If the consumer stopped waiting in the meantime, *item* goes to the
+        next waiter or back to the front of the queue (or, if the queue is
+        full, is counted in *dropped*).
+        """
+        if not future.cancelled():
+            future.set_result(item)
+            return
+        with self.cond:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                if not future.cancelled():
+                    loop.call_soon_threadsafe(self.deliver, future, item)
+                    return
+            if len(self.queue) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.queue.appendleft(item)
+            self.cond.notify()
+
+    def attach(self):
+        """Count a wrapper that delivers chunks to this subscription."""
+        with self.cond:
+            self.sources += 1
+
+    def detach(self):
+        """Stop counting a wrapper; the last one to go closes the subscription."""
+        with self.cond:
+            self.sources -= 1
+            if self.sources > 0:
+                return
+        self.close()
+
+    def close(self):
+        """Stop accepting chunks and wake the consumer."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                loop.call_soon_threadsafe(_resolve, future, None, StopAsyncIteration())
 
 class LoggingFile(object):
     """Intercept and log IO operations.
 
     The *LoggingFile* wraps a file object's read and write methods and passes the
-    incoming or outgoing data to a logger.
+    incoming or outgoing data to a logger. Other attributes are looked up on
+    the file object when they are accessed, so they are never stale.
 
     Parameters are:
 
-        * *fd* a file object; and
-        * *logger* the logger to which intercepted data will be passed.
+        * *fd* a file object;
+        * *logger* the logger to which intercepted data will be passed; and
+        * *options*, keyword arguments that override the wrapper's class
+          attributes (like :attr:`level`) for this instance.
     """
-    readers = ("read", "readline", "readlines")
+    __slots__ = ("fd", "logger", "enabled", "__dict__", "__weakref__")
+    readers = ("read", "read1", "readline", "readlines")
     """Read methods on the file object that should be wrapped."""
+    intoreaders = ("readinto", "readinto1")
+    """Methods on the file object that read into a buffer supplied by the
+    caller; see :func:`intoreader`."""
     writers = ("write", "writelines")
     """Write methods on the file object that should be wrapped."""
     level = logging.DEBUG
     """Default level used by :meth:`log`."""
+    dispatcher = None
+    """A :class:`Dispatcher` used to emit records in the background (or None
+    to emit them inline); pass True to get a new one that is closed along
+    with the wrapper."""
+    maxrecord = None
+    """Data longer than this is logged as a :class:`LazyPreview` of its ends."""
+    previewhead = 256
+    """Length of the beginning of truncated data that is logged."""
+    previewtail = 256
+    """Length of the end of truncated data that is logged."""
+    digest = "sha1"
+    """:mod:`hashlib` algorithm used to hash truncated byte strings (or None)."""
+    maxstream = None
+    """Total length of the data that may be logged; records that would exceed
+    it are suppressed."""
+    extra = None
+    """A dict of attributes added to every record (see :class:`LoggingCmd`)."""
+    policy = None
+    """An object whose *allow* method is called with the data of each record
+    that would be logged; records it rejects are suppressed. Policies like
+    :class:`SamplePolicy` keep state, so each wrapper needs its own."""
+    logencoding = None
+    """If set, byte strings are logged as text decoded with this encoding
+    (see :meth:`decode`) instead of their :func:`repr`."""
+    logerrors = "replace"
+    """Error handling scheme used when decoding (see :attr:`logencoding`)."""
+    metrics = None
+    """A :class:`StreamMetrics` updated by :meth:`logread` and
+    :meth:`logwrite`; pass True to get a new one."""
+    transcript = None
+    """A :class:`Transcript` to which :meth:`logread` and :meth:`logwrite` add
+    each chunk, under the name in :attr:`extra`'s *stream* (or the logger's
+    name)."""
+    tail = None
+    """A :class:`RingBuffer` that keeps the most recent data instead of it
+    being logged, until :meth:`dumptail` is called; pass True, or a size in
+    bytes, to get a new one."""
 
-    def __init__(self, fd, logger):
+    def __init__(self, fd, logger, **options):
         self.fd = fd
         self.logger = logger
+        self.enabled = {}
+        self.logged = 0
+        self.finished = False
+        self.suppressed = 0
+        self.suppressedbytes = 0
+        self.subscriptions = []
+        for name, value in options.items():
+            if not hasattr(type(self), name):
+                raise TypeError("unknown option: %r" % name)
+            setattr(self, name, value)
+        self.owndispatcher = self.dispatcher is True
+        if self.owndispatcher:
+            self.dispatcher = Dispatcher()
+        self.decoder = None
+        if self.logencoding is not None:
+            self.decoder = codecs.getincrementaldecoder(self.logencoding)(
+                self.logerrors)
+        if self.metrics is True:
+            self.metrics = StreamMetrics()
+        if self.tail is True:
+            self.tail = RingBuffer()
+        elif isinstance(self.tail, int):
+            self.tail = RingBuffer(self.tail)
+
+    def __getattr__(self, name):
+        if name == "fd":
+            raise AttributeError(name)
+        return getattr(self.fd, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.fd)
+        self.logread(line)
+        return line
+
+    def enabledfor(self, level):
+        """Return True if the logger would handle a record at *level*.
+
+        :class:`logging.Logger` caches its own answers until a level is
+        changed, so level changes take effect right away. Other loggers are
+        asked once per level for the life of the wrapper. Loggers without an
+        *isEnabledFor* method are always enabled.
+        """
+        if isinstance(self.logger, logging.Logger):
+            return self.logger.isEnabledFor(level)
+        try:
+            return self.enabled[level]
+        except KeyError:
+            isenabledfor = getattr(self.logger, "isEnabledFor", None)
+            enabled = isenabledfor is None or isenabledfor(level)
+            self.enabled[level] = enabled
+            return enabled
 
     def log(self, str, *args, **kwargs):
         """Log intercepted data.
 
         Arguments are as for :meth:`logging.Logger.log`, except *level* is
         pulled from *kwargs* if present; otherwise, :attr:`level` is used.
+        Nothing is done if the logger is not enabled for *level*; otherwise the
+        message is a :class:`LazyRepr` of *str* (see :meth:`preview` for data
+        longer than :attr:`maxrecord` and :meth:`decode` if :attr:`logencoding`
+        is set). Records rejected by :attr:`policy` or that would take the
+        total length logged past :attr:`maxstream` are counted in *suppressed*
+        and *suppressedbytes* instead.
         """
-        _kwargs = kwargs.copy()
-        level = _kwargs.pop("level", self.level)
-        self.logger.log(level, repr(str), *args, **_kwargs)
+        level = kwargs.pop("level", self.level)
+        if not self.enabledfor(level):
+            return
+        elif self.policy is not None and not self.policy.allow(str):
+            self.suppress(str)
+            return
+        elif self.maxrecord is None and self.maxstream is None and \
+                self.logencoding is None:
+            self.emit(level, LazyRepr(str), args, kwargs)
+            return
+
+        size = len(str)
+        truncated = self.maxrecord is not None and size > self.maxrecord
+        if truncated:
+            size = self.previewhead + self.previewtail
+        if self.maxstream is not None:
+            if self.logged + size > self.maxstream:
+                self.suppress(str)
+                return
+            self.logged += size
+
+        if truncated:
+            msg, extra = self.preview(str)
+            extra.update(kwargs.get("extra") or {})
+            kwargs["extra"] = extra
+            if self.decoder is not None:
+                self.decoder.reset()
+        elif self.logencoding is not None:
+            msg = self.decode(str)
+        else:
+            msg = LazyRepr(str)
+        self.emit(level, msg, args, kwargs)
+
+    def suppress(self, data):
+        """Count *data* as suppressed instead of logging it."""
+        self.suppressed += 1
+        self.suppressedbytes += len(data)
+        if self.decoder is not None:
+            # The next record can't finish a character started by this one.
+            self.decoder.reset()
+
+    def decode(self, data):
+        """Return a :class:`LazyText` of *data*.
+
+        Byte strings are decoded right away by an incremental decoder, so
+        that a character split between two reads (or writes) is decoded
+        whole, once. The decoder is shared by both directions, so wrappers
+        that are both read and written may see some characters mangled.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if isinstance(data, (bytes, bytearray)):
+            data = self.decoder.decode(data)
+        return LazyText(data)
+
+    def emit(self, level, msg, args, kwargs):
+        """Pass a record to the logger.
+
+        :attr:`extra` is merged into the record's extra attributes. If
+        :attr:`dispatcher` is set, the record is handed to it instead of being
+        emitted here.
+        """
+        if self.extra:
+            extra = kwargs.get("extra")
+            kwargs["extra"] = dict(self.extra, **extra) if extra else self.extra
+        if self.dispatcher is not None:
+            if isinstance(msg, LazyRepr):
+                msg = msg.snapshot()
+            self.dispatcher.put(self.logger, level, msg, args, kwargs)
+            return
+        _log(self.logger, level, msg, args, kwargs)
+
+    def preview(self, data):
+        """Prepare a preview of *data*.
+
+        Returns a :class:`LazyPreview` of the first :attr:`previewhead` and last
+        :attr:`previewtail` items of *data* and a dict of extra record
+        attributes: the original *length*, the *digest* of byte strings (see
+        :attr:`digest`) and *truncated*. Byte strings are not copied.
+        """
+        extra = dict(length=len(data), truncated=True)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = memoryview(data)
+            if self.digest is not None:
+                extra["digest"] = hashlib.new(self.digest, data).hexdigest()
+        tail = data[len(data) - self.previewtail:] if self.previewtail else data[:0]
+        return LazyPreview(data[:self.previewhead], tail), extra
+
+    def finish(self):
+        """Wrap up at the end of the stream.
+
+        If any records were suppressed, a summary is logged. :attr:`metrics`,
+        subscriptions and a :attr:`dispatcher` created by the wrapper are
+        closed. Only the first call does anything.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            if self.suppressed:
+                self.emitsuppressed()
+        finally:
+            if self.metrics is not None:
+                self.metrics.close()
+            self.endsubscriptions()
+            if self.owndispatcher:
+                self.dispatcher.close()
+
+    def close(self):
+        """Close the file object, after :meth:`finish`."""
+        try:
+            self.finish()
+        finally:
+            self.fd.close()
+
+    def emitsuppressed(self):
+        """Log the number of suppressed records and their total length."""
+        self.emit(self.level, "suppressed %d records (%d bytes)",
+            (self.suppressed, self.suppressedbytes),
+            dict(extra=dict(suppressed=self.suppressed,
+                suppressedbytes=self.suppressedbytes)))
+
+    def peek(self, *args):
+        """Return buffered data without consuming it.
+
+        The data isn't logged here; it will be when it is read.
+        """
+        return self.fd.peek(*args)
+
+    def logread(self, data, *args, **kwargs):
+        """Log *data* read from the file object.
+
+        This is the entry point for data that was read from the underlying file
+        descriptor without going through the wrapped read methods (see
+        :meth:`LoggingCmd.pump`). Arguments are as for :meth:`log`.
+        """
+        if self.subscriptions:
+            self.publish(data)
+        if self.transcript is not None:
+            self.transcript.add(self.streamname(), data)
+        log = self.log if self.tail is None else self.keep
+        if self.metrics is None:
+            log(data, *args, **kwargs)
+        else:
+            self.measure("read", log, data, args, kwargs)
+
+    def logwrite(self, data, *args, **kwargs):
+        """Log *data* written to the file object.
+
+        Like :meth:`logread`, but for outgoing data.
+        """
+        if self.subscriptions:
+            self.publish(data)
+        if self.transcript is not None:
+            self.transcript.add(self.streamname(), data)
+        log = self.log if self.tail is None else self.keep
+        if self.metrics is None:
+            log(data, *args, **kwargs)
+        else:
+            self.measure("write", log, data, args, kwargs)
+
+    def subscribe(self, callback=None, maxsize=None):
+        """Return a new :class:`Subscription` to the data read or written.
+
+        Parameters are as for :class:`Subscription`. If the file object is
+        already closed, the subscription is returned closed.
+        """
+        subscription = Subscription(callback, maxsize)
+        if not self.attach(subscription):
+            subscription.close()
+        return subscription
+
+    def attach(self, subscription):
+        """Deliver chunks to *subscription* (see :meth:`publish`).
+
+        Returns False if the wrapper has ended its subscriptions.
+        """
+        with _subscribelock:
+            if self.subscriptions is None:
+                return False
+            subscription.attach()
+            # Replaced, not changed, so publish needs no lock.
+            self.subscriptions = self.subscriptions + [subscription]
+        return True
+
+    def unsubscribe(self, subscription):
+        """Stop delivering chunks to *subscription*."""
+        with _subscribelock:
+            if subscription not in (self.subscriptions or ()):
+                return
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+        subscription.detach()
+
+    def endsubscriptions(self):
+        """Detach every subscription; later ones are returned closed.
+
+        This is done when the wrapper is closed (or, for an
+        :class:`AsyncLoggingFile`, reaches the end of its stream).
+        """
+        with _subscribelock:
+            subscriptions, self.subscriptions = self.subscriptions or [], None
+        for subscription in subscriptions:
+            subscription.detach()
+
+    def publish(self, data):
+        """Pass *data* to each subscription under :meth:`streamname`.
+
+        Mutable buffers are copied once, for all of the subscriptions; empty
+        strings (like the one read at the end of a stream) are skipped.
+        """
+        if not len(data):
+            return
+        data = _snapshot(data)
+        stream = self.streamname()
+        for subscription in self.subscriptions:
+            subscription.put(stream, data)
+
+    def expire(self):
+        """Log data that has waited too long to be logged.
+
+        Returns the time (see :func:`time.time`) by which :meth:`expire`
+        should be called again, or None if nothing is waiting. Nothing ever
+        waits here; see :meth:`LineLoggingFile.expire`.
+        """
+        return None
+
+    def keep(self, data, *args, **kwargs):
+        """Add *data* to :attr:`tail` instead of logging it.
+
+        Nothing is kept if the logger is not enabled for the record's level.
+        """
+        if self.enabledfor(kwargs.get("level", self.level)):
+            self.tail.write(data)
+
+    def dumptail(self, *args, **kwargs):
+        """Log the data kept by :attr:`tail` and empty it.
+
+        Arguments are as for :meth:`log`; the number of bytes the tail
+        *dropped* is added to the record's extra attributes.
+        """
+        if self.tail is None or not self.tail:
+            return
+        data = self.tail.getvalue()
+        extra = dict(kwargs.pop("extra", None) or {})
+        extra["dropped"] = self.tail.dropped
+        self.tail.clear()
+        self.log(data, *args, extra=extra, **kwargs)
+
+    def streamname(self):
+        """Return the name of the stream (see :attr:`transcript`)."""
+        stream = (self.extra or {}).get("stream")
+        if stream is None:
+            stream = getattr(self.logger, "name", None)
+        return stream
+
+    def measure(self, direction, log, data, args, kwargs, buf=None):
+        """Call *log* with *data* and add it to :attr:`metrics`.
+
+        *buf* is the :class:`LineBuffer` (if any) that holds the partial line
+        for *direction*.
+        """
+        start = time.monotonic()
+        try:
+            log(data, *args, **kwargs)
+        finally:
+            logtime = time.monotonic() - start
+            if buf is not None:
+                self.metrics.add(direction, len(data), buf.count(data), logtime,
+                    len(buf))
+            elif isinstance(data, (list, tuple)):
+                self.metrics.add(direction, sum(len(item) for item in data), 0,
+                    logtime)
+            else:
+                self.metrics.add(direction, len(data), 0, logtime)
 
-def wrapfd(fd, logger, wrapper):
+def wrapfd(fd, logger, wrapper, **options):
     """Wrap a file object with a logging wrapper.
 
     *fd* should be a file object; *logger* should be a :class:`logging.Logger`
-    instance. *wrapper* should take *fd* and *logger* as its two arguments and
+    instance. *wrapper* should take *fd* and *logger* as its two arguments (and
+    *options*, if any are given) and
     supply *readers* and *writers* attributes; typically, it will be the
-    :class:`LoggingFile` class or a subclass. This function instantiates the wrapper
-    and assigns the attributes of *fd* to it, skipping over methods identified
-    in the *readers* and *writers* attributes.
+    :class:`LoggingFile` class or a subclass. This function instantiates the wrapper.
+    Wrappers that delegate attribute access to *fd* (by defining *__getattr__*,
+    as :class:`LoggingFile` does) are returned as they are, so wrapping is
+    cheap; otherwise, the attributes of *fd* are assigned to the wrapper,
+    skipping over methods identified in the *readers* and *writers* attributes.
 
     Returns a wrapped file object.
     """
-    wrapped = wrapper(fd, logger)
-    attrs = (a for a in dir(wrapped.fd) 
-            if a not in (wrapper.readers + wrapper.writers))
+    wrapped = wrapper(fd, logger, **options)
+    if hasattr(wrapper, "__getattr__"):
+        return wrapped
+
+    skip = wrapper.readers + getattr(wrapper, "intoreaders", ()) + \
+        wrapper.writers + ("peek", "__dict__")
+    attrs = (a for a in dir(wrapped.fd) if a not in skip)
     for attr in attrs:
         try:
             setattr(wrapped, attr, getattr(fd, attr))
@@ -70,128 +1156,2287 @@ def wrapfd(fd, logger, wrapper):
 
     return wrapped
 
+class LoggingRawIO(io.RawIOBase):
+    """A raw :mod:`io` stream whose IO is logged by a wrapper.
+
+    *wrapped* is a :class:`LoggingFile` (or a subclass) around a raw stream,
+    like an :class:`io.FileIO` over a pipe. Reads and writes go straight to
+    that stream, and the bytes that were moved are passed to the wrapper's
+    :meth:`LoggingFile.logread` and :meth:`LoggingFile.logwrite` methods as a
+    :class:`memoryview` of the caller's buffer (see :func:`intoreader`). A
+    buffered stream on top of it (see :func:`wrapraw`) does the line
+    splitting and small reads and writes in C, and data is logged a chunk at
+    a time instead of on every call.
+
+    Closing the stream closes the wrapper.
+    """
+
+    def __init__(self, wrapped):
+        io.RawIOBase.__init__(self)
+        self.wrapped = wrapped
+
+    def readable(self):
+        return self.wrapped.fd.readable()
+
+    def writable(self):
+        return self.wrapped.fd.writable()
+
+    def fileno(self):
+        return self.wrapped.fd.fileno()
+
+    def readinto(self, b):
+        return self.wrapped.readinto(b)
+
+    def write(self, b):
+        size = self.wrapped.fd.write(b)
+        if size:
+            view = memoryview(b)
+            if view.itemsize != 1:
+                view = view.cast("B")
+            self.wrapped.logwrite(view[:size])
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.wrapped.close()
+        finally:
+            io.RawIOBase.close(self)
+
+def wrapraw(fd, logger, wrapper, buffersize=io.DEFAULT_BUFFER_SIZE, **options):
+    """Wrap the raw layer of a binary file object and buffer it again.
+
+    *fd* should be a raw stream (like an :class:`io.FileIO`) or a buffered
+    one, which is detached from its raw stream (so nothing should have been
+    read from it yet). The raw stream is wrapped with :func:`wrapfd` (passing
+    *logger*, *wrapper* and *options*) and a :class:`LoggingRawIO`.
+
+    Returns an :class:`io.BufferedReader` or :class:`io.BufferedWriter` of
+    *buffersize* over the :class:`LoggingRawIO`; the wrapper is its
+    ``raw.wrapped`` attribute.
+    """
+    if isinstance(fd, io.BufferedIOBase):
+        fd = fd.detach()
+    raw = LoggingRawIO(wrapfd(fd, logger, wrapper, **options))
+    if raw.readable():
+        return io.BufferedReader(raw, buffersize)
+    return io.BufferedWriter(raw, buffersize)
+
+def _logfile(fileobj):
+    """Return the :class:`LoggingFile` that logs *fileobj*'s IO (or None)."""
+    if isinstance(fileobj, LoggingFile):
+        return fileobj
+    raw = getattr(fileobj, "raw", None)
+    if isinstance(raw, LoggingRawIO):
+        return raw.wrapped
+    return None
+
 def reader(reader):
     """Wrap a reader method of a wrapped file object.
 
     *reader* is the name of the method. The wrapped method will call the wrapped
-    file object's *log* method (typically :meth:`LoggingFile.log`) after calling
-    the *reader* method.
+    file object's *logread* method (typically :meth:`LoggingFile.logread`)
+    after calling the *reader* method.
     """
     def wrapper(self, size=-1, *args, **kwargs):
         method = getattr(self.fd, reader)
         str = method(size)
-        self.log(str, *args, **kwargs)
+        self.logread(str, *args, **kwargs)
         return str
     return wrapper
 
+def intoreader(reader):
+    """Wrap a method that reads into a buffer supplied by the caller.
+
+    *reader* is the name of the method (like :meth:`io.RawIOBase.readinto`).
+    The wrapped method passes the bytes that were read to the wrapped file
+    object's *logread* method as a :class:`memoryview` of the caller's buffer,
+    so reading doesn't allocate anything when the logger is disabled. Records
+    handed to a :class:`Dispatcher` get a copy; handlers that keep records
+    around see whatever is in the buffer when they format them.
+    """
+    def wrapper(self, b, *args, **kwargs):
+        method = getattr(self.fd, reader)
+        size = method(b)
+        if size:
+            view = memoryview(b)
+            if view.itemsize != 1:
+                view = view.cast("B")
+            self.logread(view[:size], *args, **kwargs)
+        return size
+    return wrapper
+
 def writer(writer):
     """Wrap a writer method of a wrapped file object.
 
     *writer* is the name of the method. The wrapped method will call the wrapped
-    file object's *log* method (typically :meth:`LoggingFile.log`) before calling
-    the *writer* method.
+    file object's *logwrite* method (typically :meth:`LoggingFile.logwrite`)
+    before calling the *writer* method.
     """
     def wrapper(self, str, *args, **kwargs):
         method = getattr(self.fd, writer)
-        self.log(str, *args, **kwargs)
+        self.logwrite(str, *args, **kwargs)
         return method(str)
     return wrapper
 
 # Fill in the LoggingFile's reader and writer methods.
 for name in LoggingFile.readers:
     setattr(LoggingFile, name, reader(name))
+for name in LoggingFile.intoreaders:
+    setattr(LoggingFile, name, intoreader(name))
 for name in LoggingFile.writers:
     setattr(LoggingFile, name, writer(name))
 
-class LineLoggingFile(LoggingFile):
-    """Log each line of IO as it's written to or read from the wrapped file object.
+class RingBuffer(object):
+    """Keep the last *size* bytes written to a preallocated buffer.
+
+    Older data is overwritten as newer data arrives, so memory use is fixed
+    however much is written; :attr:`dropped` counts the bytes lost. Text is
+    kept encoded as UTF-8. If *lines* is set, :meth:`getvalue` returns no
+    more than that many lines from the end of the buffer (and never the
+    partial line left at its start after data was dropped).
     """
-    newline = "\n"
-    """The newline character(s)."""
+    size = 1 << 16
+    """Default size of the buffer, in bytes."""
 
-    def __init__(self, fd, logger):
-        LoggingFile.__init__(self, fd, logger)
-        self.readbuf = []
-        self.writebuf = []
+    def __init__(self, size=None, lines=None):
+        if size is not None:
+            if isinstance(size, bool) or size < 1:
+                raise ValueError("invalid ring buffer size: %r" % size)
+            self.size = size
+        self.lines = lines
+        self.buf = bytearray(self.size)
+        self.position = 0
 
-    def close(self):
-        try:
-            for chunk in self.readbuf:
-                self.log(chunk, extra=dict(onclose="read"))
-            for chunk in self.writebuf:
-                self.log(chunk, extra=dict(onclose="write"))
-        finally:
-            self.fd.close()
+    def __len__(self):
+        return min(self.position, self.size)
 
-    def read(self, size=-1, *args, **kwargs):
-        data = self.fd.read(size)
-        chunks = data.splitlines(True)
-        if not chunks:
-            return data
-        elif self.readbuf:
-            chunks[0] = ''.join(self.readbuf + [chunks[0]])
-            self.readbuf = []
+    @property
+    def dropped(self):
+        """Bytes written that are no longer in the buffer."""
+        return max(self.position - self.size, 0)
 
-        for chunk in chunks:
-            if not chunk.endswith(self.newline):
-                self.readbuf.append(chunk)
+    def write(self, data):
+        """Add *data* (a string or a list of strings) to the buffer."""
+        if isinstance(data, (list, tuple)):
+            data = data[0][:0].join(data) if data else b""
+        data = _tobytes(data)
+        size = len(data)
+        if size > self.size:
+            data = memoryview(data)[size - self.size:]
+        start = (self.position + size - len(data)) % self.size if self.size else 0
+        first = min(len(data), self.size - start)
+        self.buf[start:start + first] = data[:first]
+        self.buf[:len(data) - first] = data[first:]
+        self.position += size
+
+    def getvalue(self):
+        """Return the data in the buffer, oldest first."""
+        if self.position <= self.size:
+            data = bytes(self.buf[:self.position])
+        else:
+            start = self.position % self.size
+            data = bytes(self.buf[start:] + self.buf[:start])
+        if self.lines is None:
+            return data
+        start = end = len(data) - 1 if data.endswith(b"\n") else len(data)
+        for _ in range(self.lines):
+            start = data.rfind(b"\n", 0, start)
+            if start < 0:
                 break
-            self.log(chunk, *args, **kwargs)
-        return data
+        if start < 0 and self.dropped:
+            start = data.find(b"\n")
+            if start < 0:
+                # One long line; better a piece of it than nothing.
+                return data
+        return data[start + 1:]
 
-    def write(self, str, *args, **kwargs):
-        self.fd.write(str)
-        chunks = str.splitlines(True)
-        if not chunks:
-            return
-        elif self.writebuf:
-            chunks[0] = ''.join(self.writebuf + [chunks[0]])
-            self.writebuf = []
+    def clear(self):
+        """Empty the buffer."""
+        self.position = 0
 
-        for chunk in chunks:
-            if not chunk.endswith(self.newline):
-                self.writebuf.append(chunk)
-                break
-            self.log(chunk, *args, **kwargs)
+def _rfind(view, sub, window=4096):
+    """Like :meth:`bytes.rfind`, for a :class:`memoryview`.
 
-    def writelines(self, strings, *args, **kwargs):
-        for str in strings:
-            self.write(str, *args, **kwargs)
-    
-class LoggingCmd(Popen):
-    """A command subprocess that logs its IO.
+    Only the end of *view*, back to the last *sub*, is copied, a window at a
+    time.
+    """
+    end = len(view)
+    while end > 0:
+        start = max(end - window, 0)
+        # Windows overlap so that sub can't straddle two of them.
+        found = view[start:end + len(sub) - 1].tobytes().rfind(sub)
+        if found >= 0:
+            return start + found
+        end = start
+    return -1
 
-    Any data written to or read from the process' file objects will be sent
-    to a child of the process' main logger.
+class LineBuffer(object):
+    """Split a stream of strings into lines.
 
-    Parameters are:
+    Strings passed to :meth:`lines` are searched for *newline*; complete lines
+    are sliced straight out of them and the trailing partial line, if any, is
+    kept until a later string completes it. Byte strings are buffered in a
+    :class:`bytearray` (which CPython trims from the front in place); text is
+    buffered as a list of parts. *newline* may be given as text or bytes and is
+    matched against either kind of data.
 
-        * *args* command arguments (like :class:`subprocess.Popen`);
-        * *logger* a :class:`logging.Logger` instance (or something that has a
-          *name* attribute); and
-        * *kwargs*, which are passed on to :class:`subprocess.Popen`.
-    """
-    fdnames = ("stdin", "stderr", "stdout")
+    If *cr* is True and *newline* is "\\n", a lone "\\r" also ends a line (so
+    each update of a progress bar is a line of its own); "\\r\\n" is still a
+    single newline. A "\\r" at the end of a string is held until the next one
+    shows whether a "\\n" follows it.
+
+    If *maxline* is set, a partial line that grows longer than that is dealt
+    with according to *overflow*:
+
+        * "flush" yields it as it is and buffers the rest of the line afresh;
+        * "truncate" keeps its first *maxline* items and drops the rest of the
+          line (including the newline); and
+        * "spill" keeps its first *maxline* items and writes the whole line to
+          a temporary file in *spilldir*.
+
+    Lines that ran into the limit are yielded with a dict describing them in
+    :attr:`info`: *partial* for flushed lines, or the line's *length*,
+    *truncated* and, if it was spilled, the path of the *spilled* file. Only
+    the last *maxspills* spill files are kept (if it isn't None); older ones
+    are removed as new lines spill, and :meth:`cleanup` removes the rest. For
+    other lines, :attr:`info` is None.
+    """
+    overflows = ("flush", "truncate", "spill")
+    """Values accepted for *overflow*."""
+    crpatterns = (re.compile("\r\n|\n|\r(?=.)", re.S),
+        re.compile(b"\r\n|\n|\r(?=.)", re.S))
+
+    def __init__(self, newline="\n", cr=False, maxline=None, overflow="flush",
+            spilldir=None, maxspills=None):
+        if overflow not in self.overflows:
+            raise ValueError("unknown overflow policy: %r" % overflow)
+        if isinstance(newline, bytes):
+            self.bnewline = newline
+            self.tnewline = newline.decode("latin-1")
+        else:
+            self.tnewline = newline
+            self.bnewline = newline.encode("latin-1")
+        self.cr = cr and self.tnewline == "\n"
+        # re searches memoryviews in place; bytes.find would need a copy.
+        self.bpattern = re.compile(b"\r\n|\n|\r" if self.cr else re.escape(self.bnewline))
+        self.maxline = maxline
+        self.overflow = overflow
+        self.spilldir = spilldir
+        self.maxspills = maxspills
+        self.spilled = collections.deque()
+        self.buf = None
+        self.size = 0
+        self.dropped = 0
+        self.spill = None
+        self.spillpath = None
+        # The last items dropped, in case the newline starts among them.
+        self.droptail = None
+        self.pendingcr = False
+        self.info = None
+
+    def __len__(self):
+        return self.size
+
+    def newline(self, data):
+        """Return the newline matching *data*'s type."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return self.bnewline
+        return self.tnewline
+
+    def viewfind(self, view):
+        """Return a *find* method for *view*, a :class:`memoryview`.
+
+        Like :meth:`bytes.find`, but it only finds the newline, without
+        copying *view*.
+        """
+        search = self.bpattern.search
+        def find(newline, start=0):
+            match = search(view, start)
+            return -1 if match is None else match.start()
+        return find
+
+    def count(self, data):
+        """Return the number of newlines in *data*."""
+        if isinstance(data, memoryview):
+            return len(self.bpattern.findall(data))
+        newline = self.newline(data)
+        if not self.cr:
+            return data.count(newline)
+        cr = b"\r" if isinstance(newline, bytes) else "\r"
+        return data.count(newline) + data.count(cr) - data.count(cr + newline)
+
+    def extend(self, data, start=0):
+        """Buffer *data* from *start* onwards as (part of) a partial line."""
+        if start >= len(data):
+            return
+        elif self.dropped or self.spill is not None:
+            self.drop(data, start, len(data))
+            return
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if self.buf is None:
+                self.buf = bytearray()
+            self.buf += memoryview(data)[start:]
+        else:
+            if self.buf is None:
+                self.buf = []
+            self.buf.append(data[start:])
+        self.size += len(data) - start
+        if (self.maxline is not None and self.size > self.maxline and
+                self.overflow != "flush"):
+            self.limit()
+
+    def limit(self):
+        """Cut the buffered partial line down to *maxline* items."""
+        value = self.getvalue()
+        if self.overflow == "spill":
+            fd, self.spillpath = tempfile.mkstemp(prefix="prociolog-",
+                dir=self.spilldir)
+            self.spill = io.open(fd, "wb")
+            self.spill.write(_tobytes(value))
+        head = value[:self.maxline]
+        self.droptail = value[len(value) - len(self.tnewline) + 1:]
+        self.dropped = len(value) - len(head)
+        self.buf = bytearray(head) if isinstance(head, bytes) else [head]
+        self.size = len(head)
+
+    def drop(self, data, start, end):
+        """Count (or spill) the items of *data* past the kept part of a line."""
+        self.dropped += end - start
+        if self.spill is not None:
+            self.spill.write(_tobytes(data[start:end]))
+        keep = len(self.tnewline) - 1
+        if keep:
+            self.droptail = (self.droptail + data[max(start, end - keep):end])[-keep:]
+
+    def complete(self, data, end):
+        """Return the buffered partial line completed by *data* up to *end*."""
+        if self.dropped or self.spill is not None:
+            self.drop(data, 0, end)
+            return self.flush()
+        buf = self.buf
+        self.buf = None
+        self.size = 0
+        if isinstance(buf, bytearray):
+            buf += memoryview(data)[:end]
+            return bytes(buf)
+        buf.append(data[:end])
+        return data[:0].join(buf)
+
+    def lines(self, data):
+        """Generate the complete lines (including *newline*) in *data*.
+
+        A :class:`memoryview` is searched in place, and only the lines that
+        are generated are copied (as bytes), since the buffer under it is
+        usually reused.
+        """
+        if self.cr:
+            for line in self.crlines(data):
+                yield line
+            return
+        newline = self.newline(data)
+        size = len(newline)
+        view = isinstance(data, memoryview)
+        find = self.viewfind(data) if view else data.find
+        start = 0
+        end = find(newline)
+        if self.buf:
+            if end >= 0:
+                start = end + size
+            if size > 1:
+                # The newline may straddle the buffer and data.
+                if self.dropped or self.spill is not None:
+                    tail = self.droptail
+                else:
+                    tail = self.getvalue()[1 - size:]
+                split = (tail + data[:size - 1]).find(newline)
+                if 0 <= split < len(tail):
+                    start = split - len(tail) + size
+            if start:
+                yield self.complete(data, start)
+                self.info = None
+                end = find(newline, start)
+        while end >= 0:
+            end += size
+            yield data[start:end].tobytes() if view else data[start:end]
+            start = end
+            end = find(newline, start)
+        self.extend(data, start)
+        if self.maxline is not None and self.size > self.maxline:
+            # Only the "flush" policy lets the buffer outgrow maxline.
+            self.info = dict(partial=True)
+            yield self.flush()
+            self.info = None
+
+    def crlines(self, data):
+        """Like :meth:`lines`, but a lone "\\r" ends a line too."""
+        if not len(data):
+            return
+        start = 0
+        if self.pendingcr:
+            self.pendingcr = False
+            if data[:1] == self.newline(data):
+                start = 1
+                yield self.complete(data, start)
+            else:
+                yield self.flush()
+            self.info = None
+        pattern = self.crpatterns[isinstance(data, (bytes, bytearray, memoryview))]
+        for match in pattern.finditer(data, start):
+            end = match.end()
+            if self.size:
+                yield self.complete(data, end)
+                self.info = None
+            elif isinstance(data, memoryview):
+                yield data[start:end].tobytes()
+            else:
+                yield data[start:end]
+            start = end
+        self.extend(data, start)
+        self.pendingcr = data[-1:] in (b"\r", "\r")
+        if self.maxline is not None and self.size > self.maxline:
+            self.info = dict(partial=True)
+            yield self.flush()
+            self.info = None
+
+    def discard(self, data):
+        """Track the partial line at the end of *data* without splitting it.
+
+        This is much cheaper than consuming :meth:`lines` when they will not
+        be used.
+        """
+        newline = self.newline(data)
+        rfind = data.rfind if not isinstance(data, memoryview) else \
+            lambda sub: _rfind(data, sub)
+        end = rfind(newline)
+        if self.cr:
+            end = max(end, rfind(b"\r" if isinstance(newline, bytes) else "\r"))
+            self.pendingcr = False
+        if end >= 0:
+            self.reset()
+            self.extend(data, end + len(newline))
+        else:
+            self.extend(data)
+        if self.maxline is not None and (self.dropped or self.size > self.maxline):
+            # Nothing will log the line, so there's no need to keep it.
+            self.reset()
+
+    def getvalue(self):
+        """Return the buffered partial line."""
+        if self.buf is None:
+            return self.tnewline[:0]
+        elif isinstance(self.buf, bytearray):
+            return bytes(self.buf)
+        return self.buf[0][:0].join(self.buf)
+
+    def flush(self):
+        """Return the buffered partial line and empty the buffer.
+
+        If the line ran into *maxline*, :attr:`info` describes it.
+        """
+        value = self.getvalue()
+        if self.dropped or self.spill is not None:
+            self.info = dict(length=self.size + self.dropped, truncated=True)
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+                self.info["spilled"] = self.spillpath
+                self.spilled.append(self.spillpath)
+                if self.maxspills is not None:
+                    while len(self.spilled) > self.maxspills:
+                        self.removespill(self.spilled.popleft())
+            self.dropped = 0
+            self.droptail = None
+        self.buf = None
+        self.size = 0
+        return value
+
+    def reset(self):
+        """Forget the buffered partial line (and remove its spill file)."""
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            os.remove(self.spillpath)
+        self.buf = None
+        self.size = 0
+        self.dropped = 0
+        self.droptail = None
+
+    def removespill(self, path):
+        """Remove the spill file at *path*, if it still exists."""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Remove the spill files that are still kept."""
+        while self.spilled:
+            self.removespill(self.spilled.popleft())
+
+class LineBatch(object):
+    """Lines waiting to be logged as a single record."""
+    __slots__ = ("lines", "size", "started")
+
+    def __init__(self):
+        self.lines = []
+        self.size = 0
+        self.started = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add(self, line):
+        if not self.lines:
+            self.started = time.time()
+        self.lines.append(_snapshot(line))
+        self.size += len(line)
+
+    def full(self, lines=None, size=None):
+        """Return True if the batch holds at least *lines* lines or *size* bytes."""
+        return ((lines is not None and len(self.lines) >= lines) or
+            (size is not None and self.size >= size))
+
+    def expired(self, interval=None):
+        """Return True if the first line was added *interval* seconds ago."""
+        return (interval is not None and bool(self.lines) and
+            time.time() - self.started >= interval)
+
+    def deadline(self, interval=None):
+        """Return the time at which the batch expires (or None)."""
+        if interval is None or not self.lines:
+            return None
+        return self.started + interval
+
+    def flush(self):
+        """Return the joined lines and their count and empty the batch."""
+        lines = self.lines
+        self.lines = []
+        self.size = 0
+        self.started = None
+        return lines[0][:0].join(lines), len(lines)
+
+class RuleSet(object):
+    """Choose the level of each line by the patterns it matches.
+
+    *rules* is a sequence of (pattern, level) pairs; patterns may be text or
+    bytes, and are compiled with *flags* and :data:`re.MULTILINE`. A line
+    gets the highest level of the patterns found in it; lines that match
+    none get *default*, which may be None to drop them.
+
+    All of the patterns are also compiled into a single expression without
+    groups, which :mod:`re` searches about as fast as any one of them, so a
+    line that matches nothing (or a chunk of lines, see :meth:`search`) is
+    scanned once however many rules there are. Only lines that match
+    something are searched again for each level. Patterns that can't be
+    joined with others (those with inline global flags, backreferences,
+    named groups, lookbehinds or \\A and \\Z anchors) are left out of
+    that expression and searched on their own, line by line.
+
+    For example, to log tracebacks and errors as warnings and drop the rest::
+
+        rules = RuleSet([(r"Traceback|ERROR|OOM", logging.WARNING)], default=None)
+    """
+
+    uncombinable = re.compile(r"\\[1-9AZ]|\(\?(?:P[<=]|\(|<[=!]|[aiLmsux]+\))")
+    """Matches the constructs that keep a pattern out of the joined
+    expression."""
+
+    def __init__(self, rules, default=logging.DEBUG, flags=0):
+        self.default = default
+        flags |= re.M
+        bylevel = {}
+        separate = []
+        for pattern, level in rules:
+            text = _totext(pattern)
+            # Compiled alone first, so that errors point at the rule.
+            compiled = (re.compile(text, flags), re.compile(text.encode("utf-8"), flags))
+            if self.uncombinable.search(text):
+                separate.append((level,) + compiled)
+            else:
+                bylevel.setdefault(level, []).append("(?:%s)" % text)
+        self.rules = list(separate)
+        for level, patterns in bylevel.items():
+            text = "|".join(patterns)
+            self.rules.append((level, re.compile(text, flags),
+                re.compile(text.encode("utf-8"), flags)))
+        self.rules.sort(key=lambda rule: rule[0], reverse=True)
+        self.separate = sorted(separate, key=lambda rule: rule[0], reverse=True)
+        text = "|".join("|".join(patterns) for patterns in bylevel.values())
+        text = text or "(?!)"
+        self.patterns = (re.compile(text, flags), re.compile(text.encode("utf-8"), flags))
+        levels = [rule[0] for rule in self.rules]
+        if default is not None:
+            levels.append(default)
+        self.maxlevel = max(levels) if levels else logging.NOTSET
+
+    def search(self, data):
+        """Return True if any pattern is found in *data*.
+
+        If nothing is found in a chunk of lines, each of them gets the
+        default level. Patterns that are searched on their own are always
+        assumed to be found, since they may only match a line by itself.
+        """
+        if self.separate:
+            return True
+        binary = isinstance(data, (bytes, bytearray, memoryview))
+        return self.patterns[binary].search(data) is not None
+
+    def level(self, line):
+        """Return the level of *line* (or None if it should be dropped)."""
+        binary = isinstance(line, (bytes, bytearray, memoryview))
+        rules = self.rules
+        if self.patterns[binary].search(line) is None:
+            if not self.separate:
+                return self.default
+            rules = self.separate
+        for rule in rules:
+            if rule[1 + binary].search(line) is not None:
+                return rule[0]
+        return self.default
+
+class LineLoggingFile(LoggingFile):
+    """Log each line of IO as it's written to or read from the wrapped file object.
+
+    Partial lines are held in a :class:`LineBuffer` for each direction
+    (*readbuf* and *writebuf*) until they are completed or the wrapper is
+    closed.
+
+    If any of :attr:`batchlines`, :attr:`batchbytes` or :attr:`batchtime` are
+    set, complete lines are coalesced into a single record (with the number of
+    lines in its *lines* extra attribute) once any of those limits is reached.
+    :attr:`batchtime` is checked when data arrives and by :meth:`expire`,
+    which :meth:`LoggingCmd.pump` calls when a batch is due; whatever is left
+    is logged when the wrapper is closed.
+
+    If :attr:`maxline` is set, partial lines can't take more memory than that;
+    longer lines are handled by :attr:`overflow` and logged with extra
+    attributes describing what happened (see :class:`LineBuffer`).
+
+    If :attr:`rules` is set, it chooses the level of each line instead of
+    :attr:`level`. Only lines at the rules' default level are batched; the
+    others are logged on their own.
+    """
+    newline = "\n"
+    """The newline character(s); text or bytes."""
+    cr = False
+    """If True (and :attr:`newline` is "\n"), a lone "\r" also ends a line."""
+    maxline = None
+    """Length of the longest partial line that is kept in memory."""
+    overflow = "flush"
+    """What to do with longer lines: "flush", "truncate" or "spill"."""
+    spilldir = None
+    """Directory for the temporary files of spilled lines."""
+    maxspills = 16
+    """Number of spill files kept for each direction; older ones are removed
+    (see :class:`LineBuffer`). None keeps them all."""
+    batchlines = None
+    """Number of lines that fill a batch."""
+    batchbytes = None
+    """Number of bytes (or characters) that fill a batch."""
+    batchtime = None
+    """Seconds after which a batch is logged regardless of its size."""
+    rules = None
+    """A :class:`RuleSet` that chooses the level of each line (or drops it)."""
+
+    def __init__(self, fd, logger, **options):
+        LoggingFile.__init__(self, fd, logger, **options)
+        self.readbuf = LineBuffer(self.newline, self.cr, self.maxline,
+            self.overflow, self.spilldir, self.maxspills)
+        self.writebuf = LineBuffer(self.newline, self.cr, self.maxline,
+            self.overflow, self.spilldir, self.maxspills)
+        self.readbatch = LineBatch()
+        self.writebatch = LineBatch()
+        self.batching = (self.batchlines, self.batchbytes, self.batchtime) != \
+            (None, None, None)
+        # Lines from readline end at the first "\n", so they can't hold
+        # more than one newline that ends with one.
+        self.wholelines = (not self.batching and not self.readbuf.cr and
+            self.readbuf.tnewline.endswith("\n"))
+
+    def logbatch(self, batch, *args, **kwargs):
+        """Log the lines in *batch* as one record."""
+        if self.rules is not None:
+            kwargs["level"] = self.rules.default
+        data, count = batch.flush()
+        extra = dict(kwargs.pop("extra", None) or {})
+        extra["lines"] = count
+        self.log(data, *args, extra=extra, **kwargs)
+
+    def close(self):
+        try:
+            if self.readbatch:
+                self.logbatch(self.readbatch, extra=dict(onclose="read"))
+            if self.writebatch:
+                self.logbatch(self.writebatch, extra=dict(onclose="write"))
+            if self.readbuf:
+                line = self.readbuf.flush()
+                self.loginfo(line, self.readbuf.info, level=self.linelevel(line),
+                    extra=dict(onclose="read"))
+            if self.writebuf:
+                line = self.writebuf.flush()
+                self.loginfo(line, self.writebuf.info, level=self.linelevel(line),
+                    extra=dict(onclose="write"))
+        finally:
+            LoggingFile.close(self)
+
+    def loglines(self, data, buf, batch, *args, **kwargs):
+        """Log each complete line in *data*.
+
+        *buf* is the :class:`LineBuffer` holding the partial line left over from
+        the previous call and *batch* is the :class:`LineBatch` collecting lines
+        for the same direction. If the logger is not enabled for the record's
+        level, *data* isn't split at all.
+        """
+        if self.rules is not None:
+            if not self.enabledfor(self.rules.maxlevel):
+                buf.discard(data)
+            else:
+                self.logrules(data, buf, batch, *args, **kwargs)
+            return
+        elif not self.enabledfor(kwargs.get("level", self.level)):
+            buf.discard(data)
+            return
+        elif not self.batching:
+            if self.maxline is None:
+                for line in buf.lines(data):
+                    self.log(line, *args, **kwargs)
+            else:
+                for line in buf.lines(data):
+                    self.loginfo(line, buf.info, *args, **kwargs)
+            return
+
+        for line in buf.lines(data):
+            if buf.info:
+                # Lines that overflowed are logged on their own.
+                if batch:
+                    self.logbatch(batch, *args, **kwargs)
+                self.loginfo(line, buf.info, *args, **kwargs)
+                continue
+            batch.add(line)
+            if batch.full(self.batchlines, self.batchbytes):
+                self.logbatch(batch, *args, **kwargs)
+        if batch.expired(self.batchtime):
+            self.logbatch(batch, *args, **kwargs)
+
+    def logrules(self, data, buf, batch, *args, **kwargs):
+        """Log each complete line in *data* at the level chosen by :attr:`rules`.
+
+        Arguments are as for :meth:`loglines`; a *level* in *kwargs* is
+        ignored.
+        """
+        kwargs.pop("level", None)
+        default = self.rules.default
+        # A line only has to be searched if data's lines match something
+        # or one of them completes a partial line.
+        search = len(buf) > 0 or self.rules.search(data)
+        if not search and default is None:
+            buf.discard(data)
+            return
+        for line in buf.lines(data):
+            level = self.rules.level(line) if search else default
+            if level is None:
+                continue
+            elif self.batching and level == default and not buf.info:
+                batch.add(line)
+                if batch.full(self.batchlines, self.batchbytes):
+                    self.logbatch(batch, *args, **kwargs)
+                continue
+            elif batch:
+                self.logbatch(batch, *args, **kwargs)
+            self.loginfo(line, buf.info, *args, level=level, **kwargs)
+        if self.batching and batch.expired(self.batchtime):
+            self.logbatch(batch, *args, **kwargs)
+
+    def cleanup(self):
+        """Remove the spill files still kept for both directions (see
+        :attr:`maxspills`)."""
+        self.readbuf.cleanup()
+        self.writebuf.cleanup()
+
+    def expire(self):
+        """Log batches older than :attr:`batchtime`.
+
+        Returns the time at which the oldest remaining batch expires, or
+        None. Streams that aren't pumped should call this from time to time
+        if the other end may go quiet.
+        """
+        deadlines = []
+        for batch in (self.readbatch, self.writebatch):
+            if batch.expired(self.batchtime):
+                self.logbatch(batch)
+            deadline = batch.deadline(self.batchtime)
+            if deadline is not None:
+                deadlines.append(deadline)
+        return min(deadlines) if deadlines else None
+
+    def linelevel(self, line):
+        """Return the level of *line*: :attr:`level`, or as chosen by :attr:`rules`."""
+        if self.rules is None:
+            return self.level
+        return self.rules.level(line)
+
+    def loginfo(self, line, info, *args, **kwargs):
+        """Log *line* with *info* (see :attr:`LineBuffer.info`) as extra attributes.
+
+        Nothing is logged if *kwargs* has a *level* of None.
+        """
+        if "level" in kwargs and kwargs["level"] is None:
+            return
+        elif info:
+            extra = dict(kwargs.pop("extra", None) or {})
+            extra.update(info)
+            kwargs["extra"] = extra
+        self.log(line, *args, **kwargs)
+
+    def decode(self, data):
+        """Return a :class:`LazyText` of *data*.
+
+        Newlines can't split a character (in the ASCII-compatible encodings
+        that :class:`LineBuffer` supports), so lines are decoded on their own,
+        when (and if) they are formatted.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return LazyText(data, self.logencoding, self.logerrors)
+        return LazyText(data)
+
+    def logline(self, line, *args, **kwargs):
+        """Log a line read by the file object's *readline* method or iterator.
+
+        Unless a partial line is buffered (or lines are batched), a line that
+        ends with a newline is logged as it is, without searching it again.
+        """
+        if (self.wholelines and self.metrics is None and self.tail is None and
+                self.transcript is None and self.rules is None and
+                not self.subscriptions and not self.readbuf and
+                line.endswith(self.readbuf.newline(line))):
+            if self.enabledfor(kwargs.get("level", self.level)):
+                self.log(line, *args, **kwargs)
+            return
+        self.logread(line, *args, **kwargs)
+
+    def keep(self, data, *args, **kwargs):
+        """Add *data* to :attr:`tail` (see :meth:`LoggingFile.keep`).
+
+        With :attr:`rules`, data is kept if the logger is enabled for any
+        level the rules choose.
+        """
+        if self.rules is None:
+            LoggingFile.keep(self, data, *args, **kwargs)
+        elif self.enabledfor(self.rules.maxlevel):
+            self.tail.write(data)
+
+    def dumptail(self, *args, **kwargs):
+        """Log each line kept by :attr:`tail` and empty it (see
+        :meth:`LoggingFile.dumptail`)."""
+        if self.tail is None or not self.tail:
+            return
+        data = self.tail.getvalue()
+        extra = dict(kwargs.pop("extra", None) or {})
+        extra["dropped"] = self.tail.dropped
+        self.tail.clear()
+        buf = LineBuffer(self.newline, self.cr)
+        lines = list(buf.lines(data))
+        if buf:
+            lines.append(buf.flush())
+        for line in lines:
+            if self.rules is not None:
+                kwargs["level"] = self.rules.level(line)
+            self.loginfo(line, None, *args, extra=extra, **kwargs)
+
+    def logread(self, data, *args, **kwargs):
+        if self.tail is not None:
+            LoggingFile.logread(self, data, *args, **kwargs)
+            return
+        if self.subscriptions:
+            self.publish(data)
+        if self.transcript is not None:
+            self.transcript.add(self.streamname(), data)
+        if self.metrics is None:
+            self.loglines(data, self.readbuf, self.readbatch, *args, **kwargs)
+        else:
+            self.measure("read", self.loglines, data,
+                (self.readbuf, self.readbatch) + args, kwargs, self.readbuf)
+
+    def logwrite(self, data, *args, **kwargs):
+        if self.tail is not None:
+            LoggingFile.logwrite(self, data, *args, **kwargs)
+            return
+        if self.subscriptions:
+            self.publish(data)
+        if self.transcript is not None:
+            self.transcript.add(self.streamname(), data)
+        if self.metrics is None:
+            self.loglines(data, self.writebuf, self.writebatch, *args, **kwargs)
+        else:
+            self.measure("write", self.loglines, data,
+                (self.writebuf, self.writebatch) + args, kwargs, self.writebuf)
+
+    def read(self, size=-1, *args, **kwargs):
+        data = self.fd.read(size)
+        self.logread(data, *args, **kwargs)
+        return data
+
+    def read1(self, size=-1, *args, **kwargs):
+        data = self.fd.read1(size)
+        self.logread(data, *args, **kwargs)
+        return data
+
+    def __next__(self):
+        line = next(self.fd)
+        self.logline(line)
+        return line
+
+    def readline(self, size=-1, *args, **kwargs):
+        line = self.fd.readline(size)
+        self.logline(line, *args, **kwargs)
+        return line
+
+    def readlines(self, hint=-1, *args, **kwargs):
+        lines = self.fd.readlines(hint)
+        for line in lines:
+            self.logline(line, *args, **kwargs)
+        return lines
+
+    def write(self, str, *args, **kwargs):
+        self.fd.write(str)
+        self.logwrite(str, *args, **kwargs)
+
+    def writelines(self, strings, *args, **kwargs):
+        for str in strings:
+            self.write(str, *args, **kwargs)
+    
+class _Pump(object):
+    """Move data between a :class:`LoggingCmd` and its pipes.
+
+    Input is pulled from *input* (a string or an iterable of strings) and
+    written to the process' stdin as the pipe becomes writable; output is read
+    as it arrives and handed to the wrappers' :meth:`LoggingFile.logread`
+    methods. If *collect* is True, output is also kept so that it can be
+    returned by :meth:`output`.
+    """
+    pipebuf = getattr(select, "PIPE_BUF", 512)
+    """Largest write to stdin that is guaranteed not to block."""
+
+    def __init__(self, cmd, input=None, collect=True):
+        if isinstance(input, _strtypes):
+            input = [input]
+        self.cmd = cmd
+        self.input = iter(input) if input is not None else None
+        self.pending = None
+        self.collected = {}
+        self.selector = None
+        self.collect = collect
+        self.open = set()
+
+    def register(self, selector):
+        """Register the process' open pipes with *selector*.
+
+        The selector may be shared with other pumps; each key's data is a
+        (pump, fdname, wrapped file object) tuple.
+        """
+        cmd = self.cmd
+        self.selector = selector
+        for fdname in cmd.fdnames:
+            wrapped = getattr(cmd, fdname, None)
+            if wrapped is None:
+                continue
+            if fdname == "stdin":
+                try:
+                    wrapped.flush()
+                except (OSError, ValueError):
+                    pass
+                if self.input is None:
+                    self.close(fdname, wrapped)
+                    continue
+                events = selectors.EVENT_WRITE
+            else:
+                if self.collect:
+                    self.collected[fdname] = []
+                events = selectors.EVENT_READ
+            selector.register(wrapped, events, (self, fdname, wrapped))
+            self.open.add(fdname)
+
+    def ready(self, key, events, selected=None):
+        """Handle *events* on the pipe identified by *key*.
+
+        *selected* is the time (see :attr:`StreamMetrics.clock`) at which the
+        selector reported the events.
+        """
+        pump, fdname, wrapped = key.data
+        if fdname == "stdin":
+            self.write(key, fdname, wrapped)
+            return
+
+        # Archived streams are logged by their tee (see LoggingCmd.tee).
+        logfile = _logfile(wrapped)
+        metrics = getattr(logfile, "metrics", None)
+        if metrics is not None and selected is not None:
+            metrics.adddelay(metrics.clock() - selected)
+        data = os.read(key.fd, self.cmd.chunksize)
+        if not data:
+            self.close(fdname, wrapped)
+            return
+        if logfile is not None:
+            logfile.logread(data)
+        if self.collect:
+            self.collected[fdname].append(data)
+
+    def write(self, key, fdname, wrapped):
+        if not self.pending:
+            chunk = next(self.input, None)
+            if chunk is None:
+                self.close(fdname, wrapped)
+                return
+            logfile = _logfile(wrapped)
+            logfile.logwrite(chunk)
+            if not isinstance(chunk, (bytes, bytearray)):
+                encoding = getattr(logfile, "encoding", None) or "utf-8"
+                chunk = chunk.encode(encoding)
+            self.pending = memoryview(chunk)
+            if not self.pending:
+                return
+
+        try:
+            written = os.write(key.fd, self.pending[:self.pipebuf])
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.pending = None
+            self.input = iter(())
+            written = 0
+        self.pending = self.pending and self.pending[written:]
+
+    def close(self, fdname, wrapped):
+        if fdname in self.open:
+            self.selector.unregister(wrapped)
+            self.open.discard(fdname)
+        try:
+            wrapped.close()
+        except OSError:
+            pass
+
+    def done(self):
+        """Return True when all of the process' pipes are closed."""
+        return not self.open
+
+    def expire(self):
+        """Call the wrappers' :meth:`LoggingFile.expire` methods.
+
+        Returns the earliest time at which one of them should be called again,
+        or None.
+        """
+        deadlines = []
+        for fdname in self.open:
+            logfile = _logfile(getattr(self.cmd, fdname))
+            deadline = logfile and logfile.expire()
+            if deadline is not None:
+                deadlines.append(deadline)
+        return min(deadlines) if deadlines else None
+
+    def wait(self, timeout=None):
+        """Return how long to wait for events: at most *timeout* seconds (if
+        not None), and no later than the next call due to :meth:`expire`."""
+        deadline = self.expire()
+        if deadline is None:
+            return timeout
+        remaining = max(deadline - time.time(), 0)
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def abort(self):
+        """Unregister and close the pipes that are still open."""
+        for fdname in list(self.open):
+            self.close(fdname, getattr(self.cmd, fdname))
+
+    def output(self):
+        """Return a (stdout, stderr) tuple of collected output.
+
+        Streams that were not collected are None.
+        """
+        output = []
+        for fdname in ("stdout", "stderr"):
+            chunks = self.collected.get(fdname)
+            if chunks is None:
+                output.append(None)
+                continue
+            data = b"".join(chunks)
+            if getattr(self.cmd, "text_mode", False):
+                fd = getattr(self.cmd, fdname)
+                data = data.decode(getattr(fd, "encoding", None) or "utf-8")
+                data = data.replace("\r\n", "\n").replace("\r", "\n")
+            output.append(data)
+        return tuple(output)
+
+_childloggers = {}
+
+def childlogger(logger, fdname):
+    """Return the child of *logger* that logs the file object *fdname*.
+
+    Child loggers are cached by name, so building the loggers for a new
+    process doesn't take the :mod:`logging` module's lock.
+    """
+    name = logger.name + '.' + fdname
+    try:
+        return _childloggers[name]
+    except KeyError:
+        child = _childloggers[name] = logging.getLogger(name)
+        return child
+
+_kernelcopy = None
+
+def _spliceops():
+    """Return (tee, splice) functions for the Linux system calls, or None.
+
+    Both take a source fd, a destination fd and a length, return the number
+    of bytes moved (0 at the end of the source) and raise :exc:`OSError`.
+    """
+    global _kernelcopy
+    if _kernelcopy is not None:
+        return _kernelcopy or None
+    _kernelcopy = ()
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        tee = libc.tee
+        splice = libc.splice
+    except (ImportError, OSError, AttributeError):
+        return None
+    tee.restype = splice.restype = ctypes.c_ssize_t
+    tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+
+    def call(func, *args):
+        while True:
+            result = func(*args)
+            if result >= 0:
+                return result
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+
+    if hasattr(os, "splice"):
+        _splice = os.splice
+    else:
+        def _splice(source, dest, size):
+            return call(splice, source, None, dest, None, size, 0)
+    _kernelcopy = (lambda source, dest, size: call(tee, source, dest, size, 0),
+        _splice)
+    return _kernelcopy
+
+def _writeall(fd, data):
+    """Write all of *data* (a :class:`memoryview`) to *fd*."""
+    while data:
+        data = data[os.write(fd, data):]
+
+class _Tee(object):
+    """Copy an output pipe of a :class:`LoggingCmd` to an archive.
+
+    A thread moves everything the process writes to the pipe read by
+    *wrapped* (a :class:`LoggingFile`) into the *archive* file descriptor and
+    the *consumer* pipe (the write end of the pipe that replaces the
+    process' file object). On Linux, the data is duplicated with tee(2) and
+    moved with splice(2), so it never enters Python; elsewhere, or if the
+    archive can't be spliced to (a file opened for appending, say), it is
+    copied through a reused buffer. If the consumer's end is closed, the
+    archive still gets the rest of the data.
+
+    When the pipe is closed, a single record is logged by the wrapper with
+    the number of bytes archived (*archived*), the *method* used and the
+    *started* and *finished* timestamps.
+    """
+
+    def __init__(self, wrapped, consumer, archive, chunksize):
+        self.wrapped = wrapped
+        self.source = wrapped.fileno()
+        self.consumer = consumer
+        self.archive = archive if isinstance(archive, int) else archive.fileno()
+        self.chunksize = chunksize
+        self.method = "splice"
+        self.size = 0
+        self.started = self.finished = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def join(self, timeout=None):
+        """Wait for the pipe to be closed and the summary logged."""
+        self.thread.join(timeout)
+
+    def run(self):
+        self.started = time.time()
+        try:
+            if not self.splice():
+                self.method = "copy"
+                self.copy()
+        finally:
+            self.finished = time.time()
+            try:
+                self.summarize()
+            finally:
+                # Close the consumer's pipe last, so that reaching its end
+                # means the summary has been logged.
+                self.closeconsumer()
+                self.wrapped.close()
+
+    def splice(self):
+        """Move data in the kernel; return False if it has to be copied instead."""
+        ops = _spliceops()
+        if ops is None:
+            return False
+        tee, splice = ops
+        while True:
+            if self.consumer is None:
+                size = self.splicearchive(splice, self.chunksize)
+                if size is None:
+                    return False
+                elif not size:
+                    return True
+                continue
+            try:
+                size = tee(self.source, self.consumer, self.chunksize)
+            except OSError as e:
+                if e.errno == errno.EPIPE:
+                    self.closeconsumer()
+                    continue
+                elif e.errno == errno.EINVAL and not self.size:
+                    return False
+                raise
+            if not size:
+                return True
+            # Move the duplicated data out of the source pipe.
+            remaining = size
+            while remaining:
+                moved = self.splicearchive(splice, remaining)
+                if moved is None:
+                    self.copy(remaining, False)
+                    return False
+                remaining -= moved
+
+    def splicearchive(self, splice, size):
+        """Move up to *size* bytes to the archive; return None if it can't be spliced."""
+        try:
+            moved = splice(self.source, self.archive, size)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                return None
+            raise
+        self.size += moved
+        return moved
+
+    def copy(self, limit=None, consumer=True):
+        """Copy data through a buffer until the end of the pipe (or *limit* bytes)."""
+        buf = bytearray(self.chunksize)
+        view = memoryview(buf)
+        source = io.FileIO(self.source, "r", closefd=False)
+        while limit is None or limit > 0:
+            size = source.readinto(view[:limit] if limit is not None else buf)
+            if not size:
+                return
+            _writeall(self.archive, view[:size])
+            if consumer:
+                self.writeconsumer(view[:size])
+            self.size += size
+            if limit is not None:
+                limit -= size
+
+    def writeconsumer(self, data):
+        if self.consumer is None:
+            return
+        try:
+            _writeall(self.consumer, data)
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.closeconsumer()
+
+    def closeconsumer(self):
+        if self.consumer is not None:
+            os.close(self.consumer)
+            self.consumer = None
+
+    def summarize(self):
+        """Log the number of bytes archived."""
+        wrapped = self.wrapped
+        if not wrapped.enabledfor(wrapped.level):
+            return
+        elapsed = self.finished - self.started
+        wrapped.emit(wrapped.level, "archived %d bytes (%s) in %.3fs",
+            (self.size, self.method, elapsed),
+            dict(extra=dict(archived=self.size, method=self.method,
+                started=self.started, finished=self.finished)))
+
+class _CmdStreams(object):
+    """Wrapping of a process' streams, shared by :class:`LoggingCmd` and
+    :class:`AsyncLoggingCmd`.
+
+    Subclasses set *pid*, *args* and *logger*, and the process' streams as
+    attributes named by :attr:`fdnames`, before calling :meth:`wrapfds`.
+    """
+    fdnames = ("stdin", "stderr", "stdout")
     """File objects that should be wrapped."""
     wrapper = LoggingFile
     """Wrapper class for the process' file objects."""
+    options = {}
+    """Options passed to the wrapper of every file object (see
+    :class:`LoggingFile`)."""
+    fdoptions = {}
+    """Options passed to the wrapper of a single file object, keyed by name.
+    These take precedence over :attr:`options`."""
+    rawio = False
+    """If True (and the process' pipes are binary), each wrapper logs the
+    raw layer of its pipe under a new buffered file object (see
+    :func:`wrapraw`): reads and writes on the process' file objects are done
+    in C, and data is logged a chunk at a time. The wrappers are found with
+    :meth:`logfile`."""
+    text_mode = False
+    """True if the process' streams are text (:class:`subprocess.Popen`
+    sets this)."""
 
-    def __init__(self, args, logger, **kwargs):
+    def wrapfds(self):
+        """Wrap the process' file objects.
+
+        Creates a logger for each file object (see :func:`childlogger`, :attr:`fdnames`,
+        :attr:`wrapper`, :attr:`options` and :attr:`fdoptions`).
+        """
+        for fdname in self.fdnames:
+            fd = getattr(self, fdname)
+            logger = childlogger(self.logger, fdname)
+            options = dict(self.options)
+            options.update(self.fdoptions.get(fdname, {}))
+            extra = dict(pid=self.pid, argv=self.args, stream=fdname)
+            extra.update(options.get("extra") or {})
+            options["extra"] = extra
+            if self.rawio and not self.text_mode:
+                wrapped = wrapraw(fd, logger, self.wrapper, **options)
+            else:
+                wrapped = wrapfd(fd, logger, self.wrapper, **options)
+            setattr(self, fdname, wrapped)
+
+    def logfile(self, fdname):
+        """Return the wrapper that logs the stream *fdname*.
+
+        That's the process' file object itself, or with :attr:`rawio`, the
+        wrapper under it. Returns None for streams that aren't logged (like
+        those archived by :meth:`tee`).
+        """
+        return _logfile(getattr(self, fdname))
+
+    def subscribe(self, callback=None, maxsize=None, fdnames=None):
+        """Return a :class:`Subscription` to the data crossing the process' pipes.
+
+        Chunks from each of *fdnames* (by default, all of :attr:`fdnames`
+        that are wrapped) are delivered as (stream, data) pairs. The
+        subscription is closed once all of those streams are. Other
+        parameters are as for :class:`Subscription`.
+        """
+        subscription = Subscription(callback, maxsize)
+        for fdname in self.fdnames if fdnames is None else fdnames:
+            wrapped = self.logfile(fdname)
+            if wrapped is not None:
+                wrapped.attach(subscription)
+        if not subscription.sources:
+            subscription.close()
+        return subscription
+
+class LoggingCmd(_CmdStreams, Popen):
+    """A command subprocess that logs its IO.
+
+    Any data written to or read from the process' file objects will be sent
+    to a child of the process' main logger. Each record carries the process'
+    *pid*, its *argv* and the *stream* name as extra attributes.
+
+    Parameters are:
+
+        * *args* command arguments (like :class:`subprocess.Popen`);
+        * *logger* a :class:`logging.Logger` instance (or something that has a
+          *name* attribute);
+        * *options* overrides :attr:`options`;
+        * *fdoptions* overrides :attr:`fdoptions`;
+        * *archives* overrides :attr:`archives`; and
+        * *kwargs*, which are passed on to :class:`subprocess.Popen`.
+
+    For example, to emit stdout's records from a background thread and only
+    log a sample of stderr (one :class:`Dispatcher`, and its thread, serves
+    every command)::
+
+        dispatcher = Dispatcher(policy="drop-oldest")
+        cmd = LoggingCmd(args, logger, fdoptions={
+            "stdout": {"dispatcher": dispatcher},
+            "stderr": {"policy": SamplePolicy(100)}})
+
+    Pass ``{"dispatcher": True}`` instead to give each stream a dispatcher of
+    its own, closed when the stream is.
+
+    To see how the process' streams were interleaved (see
+    :class:`Transcript`)::
+
+        transcript = Transcript()
+        cmd = LoggingCmd(args, logger, options={"transcript": transcript})
+
+    To log only the last 64KiB of each stream, and only if the process fails
+    (see :meth:`dumptails`)::
+
+        cmd = LoggingCmd(args, logger, options={"tail": 65536})
+
+    To keep a copy of everything written to stdout without logging it (see
+    :meth:`tee`)::
+
+        with open("stdout.bin", "wb") as archive:
+            cmd = LoggingCmd(args, logger, archives={"stdout": archive})
+            stdout, stderr = cmd.communicate()
+    """
+    chunksize = 32768
+    """Largest read made from a pipe by :meth:`pump`."""
+    archives = {}
+    """File descriptors (or file objects) keyed by the name of an output
+    stream; the stream is copied to its archive by :meth:`tee`."""
+
+    def __init__(self, args, logger, options=None, fdoptions=None,
+            archives=None, **kwargs):
+        if "stdin" in (self.archives if archives is None else archives):
+            raise ValueError("only output streams can be archived")
         _kwargs = kwargs.copy()
         for fdname in self.fdnames:
             _kwargs[fdname] = PIPE
         Popen.__init__(self, args, **_kwargs)
+        self.args = args
         self.logger = logger
+        if options is not None:
+            self.options = options
+        if fdoptions is not None:
+            self.fdoptions = fdoptions
+        if archives is not None:
+            self.archives = archives
+        self.pumper = None
         self.wrapfds()
+        self.tees = {}
+        for fdname, archive in self.archives.items():
+            self.tees[fdname] = self.tee(fdname, archive)
 
-    def wrapfds(self):
-        """Wrap the process' file objects.
+    def tee(self, fdname, archive):
+        """Copy the output stream *fdname* to *archive* as it arrives.
 
-        Creates a logger for each file object (see :attr:`fdnames` and
-        :attr:`wrapper`).
+        The stream's wrapper is replaced by a plain file object reading a new
+        pipe, which gets the same data as *archive*. The data itself is not
+        logged; instead, the wrapper logs the number of bytes archived when
+        the stream is closed. On Linux, the data is moved with tee(2) and
+        splice(2) and never copied into Python. Close the new file object if
+        its data isn't needed; *archive* is left open.
+
+        Returns the object that does the copying; its *size* attribute counts
+        the bytes archived and its *join* method waits until the stream is
+        closed.
         """
-        name = self.logger.name
+        wrapped = self.logfile(fdname)
+        reader, writer = os.pipe()
+        tee = _Tee(wrapped, writer, archive, self.chunksize)
+        if self.text_mode:
+            fd = io.open(reader, "r", encoding=wrapped.encoding,
+                errors=wrapped.errors)
+        else:
+            fd = os.fdopen(reader, "rb")
+        setattr(self, fdname, fd)
+        tee.start()
+        return tee
+
+    def streammetrics(self):
+        """Return (labels, :class:`StreamMetrics`) pairs for :func:`formatmetrics`.
+
+        There's a pair for each wrapper with metrics (see the *metrics*
+        option of :class:`LoggingFile`), labelled with the process' *pid*,
+        *command* and *stream*.
+        """
+        command = self.args if isinstance(self.args, _strtypes) else self.args[0]
+        pairs = []
         for fdname in self.fdnames:
-            fd = getattr(self, fdname)
-            logger = logging.getLogger(name + '.' + fdname)
-            setattr(self, fdname, wrapfd(fd, logger, self.wrapper))
+            wrapped = self.logfile(fdname)
+            if fdname in self.tees:
+                wrapped = self.tees[fdname].wrapped
+            metrics = getattr(wrapped, "metrics", None)
+            if metrics is not None:
+                labels = dict(pid=self.pid, command=command, stream=fdname)
+                pairs.append((labels, metrics))
+        return pairs
+
+    def dumptails(self, *args, **kwargs):
+        """Log the data kept by each wrapper's :attr:`LoggingFile.tail`.
+
+        This is called by :meth:`poll` and :meth:`wait` when they see that
+        the process failed. Arguments are as for :meth:`LoggingFile.log`.
+        """
+        for fdname in self.fdnames:
+            wrapped = self.logfile(fdname)
+            if getattr(wrapped, "tail", None) is not None:
+                wrapped.dumptail(*args, **kwargs)
+
+    def poll(self):
+        returncode = Popen.poll(self)
+        if returncode:
+            self.dumptails()
+        return returncode
+
+    def wait(self, *args, **kwargs):
+        returncode = Popen.wait(self, *args, **kwargs)
+        if returncode:
+            self.dumptails()
+        return returncode
+
+    def pump(self, input=None, timeout=None, collect=True):
+        """Move data through the process' pipes until they are all closed.
+
+        All of the pipes are multiplexed with a selector in the calling thread,
+        so a process that fills one pipe while we wait on another never stalls.
+        Data is logged by the wrappers' :meth:`LoggingFile.logread` and
+        :meth:`LoggingFile.logwrite` methods as it crosses the pipes.
+
+        *input* may be a string or an iterable of strings, which is consumed
+        lazily so that input can be streamed to the process; stdin is closed
+        when it is exhausted (or right away if *input* is None). If *timeout*
+        seconds pass first, :exc:`TimeoutExpired` is raised; calling
+        :meth:`pump` again resumes where the last call left off. If *collect*
+        is False, output is logged but not kept.
+
+        Returns a (stdout, stderr) tuple like :meth:`communicate`. Pipes are
+        read directly, so this only works on POSIX systems.
+        """
+        if self.pumper is None:
+            self.pumper = _Pump(self, input, collect)
+            self.pumper.register(selectors.DefaultSelector())
+
+        pumper = self.pumper
+        endtime = None if timeout is None else time.time() + timeout
+        while not pumper.done():
+            remaining = None
+            if endtime is not None:
+                remaining = endtime - time.time()
+                if remaining <= 0:
+                    raise TimeoutExpired(self.args, timeout)
+            ready = pumper.selector.select(pumper.wait(remaining))
+            selected = time.monotonic()
+            for key, events in ready:
+                pumper.ready(key, events, selected)
+
+        pumper.selector.close()
+        return pumper.output()
+
+    def communicate(self, input=None, timeout=None):
+        """Interact with the process and wait for it to terminate.
+
+        Like :meth:`subprocess.Popen.communicate`, but data is passed through
+        the logging wrappers by :meth:`pump`. Returns a (stdout, stderr) tuple.
+        """
+        endtime = None if timeout is None else time.time() + timeout
+        output = self.pump(input, timeout)
+        if endtime is None:
+            self.wait()
+        else:
+            self.wait(max(endtime - time.time(), 0))
+        return output
+
+class CmdResult(collections.namedtuple("CmdResult",
+        "index args returncode stdout stderr started finished error",
+        defaults=(None,))):
+    """The outcome of a command run by a :class:`LoggingCmdPool`.
+
+    *index* is the command's position in the sequence passed to
+    :meth:`LoggingCmdPool.run`; *started* and *finished* are timestamps. If
+    the command couldn't be started, *error* is the exception raised and
+    *returncode*, *stdout* and *stderr* are None.
+    """
+    __slots__ = ()
+
+    @property
+    def elapsed(self):
+        """Seconds between starting the command and reaping it."""
+        return self.finished - self.started
+
+class LoggingCmdPool(object):
+    """Run many commands with bounded concurrency.
+
+    Up to *size* instances of :attr:`cmdclass` run at a time, and the pipes of
+    all of them are multiplexed through a single selector in the calling
+    thread (see :meth:`LoggingCmd.pump`). Child loggers come from the
+    :func:`childlogger` cache. Parameters are:
+
+        * *logger* the logger passed to each command;
+        * *size* the maximum number of commands running at once;
+        * *collect* if False, output is logged but not kept; and
+        * *kwargs*, which are passed on to :attr:`cmdclass`.
+    """
+    cmdclass = LoggingCmd
+    """Class used to run each command."""
+    reapinterval = 0.01
+    """Seconds to wait between checks on commands that closed their pipes but
+    haven't exited."""
+
+    def __init__(self, logger, size=8, collect=True, **kwargs):
+        self.logger = logger
+        self.size = size
+        self.collect = collect
+        self.kwargs = kwargs
+
+    def run(self, commands, input=None):
+        """Run *commands*, a sequence of argument lists.
+
+        *input* is sent to each command (as for :meth:`LoggingCmd.pump`); an
+        iterable of strings is consumed once, up front. Generates a
+        :class:`CmdResult` for each command as it finishes, or as it fails to
+        start. If the generator is closed early, commands that are still
+        running are killed.
+        """
+        if input is not None and not isinstance(input, _strtypes):
+            input = list(input)
+        commands = enumerate(commands)
+        selector = selectors.DefaultSelector()
+        running = {}
+        exiting = []
+        try:
+            while True:
+                while len(running) + len(exiting) < self.size:
+                    command = next(commands, None)
+                    if command is None:
+                        break
+                    index, args = command
+                    started = time.time()
+                    try:
+                        cmd = self.cmdclass(args, self.logger, **self.kwargs)
+                    except (OSError, SubprocessError) as e:
+                        yield CmdResult(index, args, None, None, None, started,
+                            time.time(), e)
+                        continue
+                    cmd.pumper = _Pump(cmd, input, self.collect)
+                    cmd.pumper.register(selector)
+                    running[cmd.pumper] = (index, started)
+
+                for pump in [p for p in running if p.done()]:
+                    exiting.append((pump,) + running.pop(pump))
+                for item in exiting[:]:
+                    pump, index, started = item
+                    if pump.cmd.poll() is None:
+                        continue
+                    exiting.remove(item)
+                    stdout, stderr = pump.output()
+                    yield CmdResult(index, pump.cmd.args, pump.cmd.returncode,
+                        stdout, stderr, started, time.time())
+
+                if not running and not exiting:
+                    break
+                elif not running:
+                    time.sleep(self.reapinterval)
+                    continue
+                timeout = self.reapinterval if exiting else None
+                for pump in running:
+                    timeout = pump.wait(timeout)
+                ready = selector.select(timeout)
+                selected = time.monotonic()
+                for key, events in ready:
+                    key.data[0].ready(key, events, selected)
+        finally:
+            for pump in list(running) + [item[0] for item in exiting]:
+                pump.abort()
+                if pump.cmd.poll() is None:
+                    pump.cmd.kill()
+                    pump.cmd.wait()
+            selector.close()
+
+def run_many(commands, logger, size=8, input=None, **kwargs):
+    """Run *commands* with a :class:`LoggingCmdPool`.
+
+    Returns a list of :class:`CmdResult` instances in the order the commands
+    finished. Other arguments are as for :class:`LoggingCmdPool`.
+    """
+    return list(LoggingCmdPool(logger, size, **kwargs).run(commands, input))
+
+_CAPTUREMAGIC = b"PIOCAP1\n"
+_CAPTUREHEADER = struct.Struct("<dIQIB")
+_CAPTUREINDEX = struct.Struct("<dQ")
+
+def _capturedata(record):
+    """Return the raw data of a record logged by a :class:`LoggingFile`.
+
+    Records whose message isn't a :class:`LazyRepr` of intercepted data (like
+    the summary of suppressed records) return None.
+    """
+    if not isinstance(record.msg, LazyRepr):
+        return None
+    data = record.msg.data
+    if isinstance(data, (list, tuple)):
+        data = data[0][:0].join(data) if data else b""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return data.encode("utf-8")
+
+def _packrecord(created, pid, stream, offset, data):
+    """Return the header of a capture record; *data* follows it."""
+    stream = stream.encode("utf-8")[:255]
+    return _CAPTUREHEADER.pack(created, pid, offset, len(data), len(stream)) + stream
+
+def _capturerecords(buf, view, position, size, pid=None, stream=None,
+        start=None, end=None):
+    """Generate :class:`CaptureRecord` instances from *buf*.
+
+    Records between *position* and *size* that match *pid*, *stream*, *start*
+    and *end* (see :meth:`CaptureReader.records`) are generated with their
+    data sliced from *view*. A record that was only partly written ends the
+    search; so does one newer than *end*, after generating None.
+    """
+    headersize = _CAPTUREHEADER.size
+    while position + headersize <= size:
+        created, rpid, offset, length, namelength = \
+            _CAPTUREHEADER.unpack_from(buf, position)
+        begin = position + headersize + namelength
+        position = begin + length
+        if position > size:
+            return
+        elif end is not None and created > end:
+            yield None
+            return
+        elif start is not None and created < start:
+            continue
+        elif pid is not None and rpid != pid:
+            continue
+        name = buf[begin - namelength:begin].decode("utf-8")
+        if stream is not None and name != stream:
+            continue
+        yield CaptureRecord(created, rpid, name, offset, view[begin:position])
+
+def _readindex(path, size):
+    """Return the times and positions in the index at *path*.
+
+    Entries pointing at or past *size* (the size of the indexed file) are
+    ignored.
+    """
+    times, positions = [], []
+    try:
+        with open(path, "rb") as f:
+            index = f.read()
+    except OSError:
+        return times, positions
+    entrysize = _CAPTUREINDEX.size
+    for start in range(0, len(index) - entrysize + 1, entrysize):
+        when, position = _CAPTUREINDEX.unpack_from(index, start)
+        if position >= size:
+            break
+        times.append(when)
+        positions.append(position)
+    return times, positions
+
+class CaptureRecord(collections.namedtuple("CaptureRecord",
+        "time pid stream offset data")):
+    """A chunk of intercepted data read back by a :class:`CaptureReader`.
+
+    *offset* is the position of *data* in its stream. *data* is a
+    :class:`memoryview` of the mapped capture file (or, from an
+    :class:`ArchiveReader`, of a decompressed frame), so it must be copied if
+    it is needed after the reader is closed.
+    """
+    __slots__ = ()
+
+class CaptureHandler(logging.Handler):
+    """Append the raw data of intercepted IO to a binary capture file.
+
+    Unlike a text handler, nothing is formatted: each record is written as a
+    fixed header (its creation time, the *pid* and *stream* extra attributes
+    added by :class:`LoggingCmd`, the position of the data in the stream and
+    its length) followed by the data itself. Records without a *pid* are
+    captured with pid 0, and records without a *stream* use their logger's
+    name. Text is encoded as UTF-8; records truncated by
+    :attr:`LoggingFile.maxrecord` contribute their head only. Records that
+    don't carry intercepted data, like the summary logged when records were
+    suppressed, are not captured.
+
+    Every :attr:`indexinterval` bytes, the time and position of the next
+    record are appended to a sparse index (*path* plus ".idx") so that a
+    :class:`CaptureReader` can find a point in time without scanning the
+    capture. Both files are only ever appended to.
+    """
+    indexinterval = 1 << 16
+    """Bytes of capture between entries in the index."""
+
+    def __init__(self, path, level=logging.NOTSET, indexinterval=None):
+        logging.Handler.__init__(self, level)
+        if indexinterval is not None:
+            self.indexinterval = indexinterval
+        self.path = path
+        self.file = io.open(path, "ab")
+        self.indexfile = io.open(path + ".idx", "ab")
+        self.position = self.file.tell()
+        if self.position:
+            # Earlier records can't be newer than now.
+            self.maxtime = time.time()
+        else:
+            self.file.write(_CAPTUREMAGIC)
+            self.position = len(_CAPTUREMAGIC)
+            self.maxtime = 0.0
+        self.indexed = self.position
+        self.offsets = {}
+
+    def emit(self, record):
+        try:
+            data = _capturedata(record)
+            if data is None:
+                return
+            pid = getattr(record, "pid", 0)
+            stream = getattr(record, "stream", record.name)
+            key = (pid, stream)
+            offset = self.offsets.get(key, 0)
+            self.offsets[key] = offset + getattr(record, "length", len(data))
+            header = _packrecord(record.created, pid, stream, offset, data)
+            self.write(record.created, header, data)
+        except Exception:
+            self.handleError(record)
+
+    def write(self, created, header, data):
+        """Append a record's *header* and *data* to the capture."""
+        if self.position - self.indexed >= self.indexinterval:
+            # Records before this one are no newer than maxtime.
+            self.indexfile.write(_CAPTUREINDEX.pack(self.maxtime, self.position))
+            self.indexed = self.position
+        self.file.write(header)
+        self.file.write(data)
+        self.position += len(header) + len(data)
+        self.maxtime = max(self.maxtime, created)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.file.flush()
+            self.indexfile.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self.file.close()
+            self.indexfile.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+class CaptureReader(object):
+    """Read a file written by a :class:`CaptureHandler`.
+
+    The capture is memory-mapped and its index loaded, so that
+    :meth:`records` can jump close to the start of a time range instead of
+    reading the capture from the beginning. A record that was only partly
+    written (if the writer crashed, say) ends the capture.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b""
+        if self.map[:len(_CAPTUREMAGIC)] != _CAPTUREMAGIC:
+            self.close()
+            raise ValueError("not a capture file: %r" % path)
+        self.view = memoryview(self.map)
+        self.times, self.positions = _readindex(path + ".idx", self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def seek(self, start=None):
+        """Return the position of the first record that may be newer than *start*."""
+        if start is None:
+            return len(_CAPTUREMAGIC)
+        i = bisect.bisect_left(self.times, start)
+        return self.positions[i - 1] if i else len(_CAPTUREMAGIC)
+
+    def records(self, pid=None, stream=None, start=None, end=None):
+        """Generate :class:`CaptureRecord` instances.
+
+        Only records for *pid* and *stream* (if given) created between *start*
+        and *end* (inclusive, if given) are generated. Records are assumed to
+        have been captured in time order, so the first record newer than *end*
+        ends the search.
+        """
+        for record in _capturerecords(self.map, self.view, self.seek(start),
+                self.size, pid, stream, start, end):
+            if record is None:
+                return
+            yield record
+
+    def read(self, pid=None, stream=None, start=None, end=None):
+        """Return the data of the matching :meth:`records` joined together."""
+        return b"".join(bytes(record.data)
+            for record in self.records(pid, stream, start, end))
+
+    def close(self):
+        """Unmap and close the capture file."""
+        self.view = None
+        if not isinstance(self.map, bytes):
+            try:
+                self.map.close()
+            except BufferError:
+                # Records still refer to the map; it's closed once they're gone.
+                pass
+        self.file.close()
+
+_ARCHIVEMAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+class ArchiveHandler(CaptureHandler):
+    """Append the raw data of intercepted IO to a compressed capture.
+
+    Records are built like a :class:`CaptureHandler`'s, but are collected in
+    frames of about :attr:`framesize` bytes. Full frames are compressed and
+    written by a background thread, so the threads pumping the pipes only
+    copy data. Each frame is an independent gzip member (or zstd frame), so
+    ``gzip -dc`` turns an archive back into a capture file; an entry in the
+    index (*path* plus ".idx") records the time and position of every frame.
+    If the thread falls :attr:`maxframes` frames behind, :meth:`emit` waits
+    for it rather than dropping data.
+
+    The frame being collected is only written by :meth:`flush` or
+    :meth:`close`.
+    """
+    compression = "gzip"
+    """The compressor: "gzip", or "zstd" if the zstandard module is installed."""
+    compressions = ("gzip", "zstd")
+    framesize = 1 << 22
+    """Bytes of capture in each compressed frame."""
+    compresslevel = 6
+    """The level passed to the compressor."""
+    maxframes = 4
+    """Full frames waiting to be compressed before :meth:`emit` blocks."""
+
+    def __init__(self, path, level=logging.NOTSET, compression=None,
+            framesize=None, compresslevel=None):
+        logging.Handler.__init__(self, level)
+        if compression is not None:
+            self.compression = compression
+        if self.compression not in self.compressions:
+            raise ValueError("unknown compression: %r" % self.compression)
+        elif self.compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard module")
+        if framesize is not None:
+            self.framesize = framesize
+        if compresslevel is not None:
+            self.compresslevel = compresslevel
+        self.path = path
+        self.file = io.open(path, "ab")
+        self.indexfile = io.open(path + ".idx", "ab")
+        self.frame = bytearray()
+        if self.file.tell():
+            self.maxtime = time.time()
+        else:
+            self.frame += _CAPTUREMAGIC
+            self.maxtime = 0.0
+        self.framemaxtime = self.maxtime
+        self.offsets = {}
+        self.frames = collections.deque()
+        self.cond = threading.Condition()
+        self.unfinished = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, name="prociolog-archive")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, created, header, data):
+        self.frame += header
+        self.frame += data
+        self.maxtime = max(self.maxtime, created)
+        if len(self.frame) >= self.framesize:
+            self.rotate()
+
+    def rotate(self):
+        """Queue the current frame to be compressed and start a new one."""
+        if not self.frame:
+            return
+        with self.cond:
+            while len(self.frames) >= self.maxframes:
+                self.cond.wait()
+            # Records before this frame are no newer than framemaxtime.
+            self.frames.append((self.framemaxtime, self.frame))
+            self.unfinished += 1
+            self.cond.notify_all()
+        self.frame = bytearray()
+        self.framemaxtime = self.maxtime
+
+    def compress(self, frame):
+        """Return *frame* compressed as a standalone gzip member or zstd frame."""
+        if self.compression == "zstd":
+            compressor = zstandard.ZstdCompressor(level=self.compresslevel)
+            return compressor.compress(bytes(frame))
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(bytes(frame)) + compressor.flush()
+
+    def run(self):
+        """Compress and write queued frames until a None frame is queued."""
+        while True:
+            with self.cond:
+                while not self.frames:
+                    self.cond.wait()
+                item = self.frames.popleft()
+                self.cond.notify_all()
+            if item is None:
+                return
+            maxtime, frame = item
+            try:
+                data = self.compress(frame)
+                self.indexfile.write(_CAPTUREINDEX.pack(maxtime, self.file.tell()))
+                self.file.write(data)
+            except Exception:
+                with self.cond:
+                    self.errors += 1
+            with self.cond:
+                self.unfinished -= 1
+                self.cond.notify_all()
+
+    def flush(self):
+        """Compress and write every record emitted so far."""
+        self.acquire()
+        try:
+            if not self.thread.is_alive():
+                return
+            self.rotate()
+            with self.cond:
+                while self.unfinished:
+                    self.cond.wait()
+            self.file.flush()
+            self.indexfile.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.thread.is_alive():
+                self.flush()
+                with self.cond:
+                    self.frames.append(None)
+                    self.cond.notify_all()
+                self.thread.join()
+            self.file.close()
+            self.indexfile.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+class ArchiveReader(CaptureReader):
+    """Read a file written by an :class:`ArchiveHandler`.
+
+    Like a capture, the archive is memory-mapped. Frames are decompressed one
+    at a time as :meth:`records` reaches them; the index is used to skip
+    frames that are older than the start of a time range. A frame that was
+    only partly written ends the archive.
+    """
+    chunksize = 1 << 16
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b""
+        self.view = None
+        self.compression = _ARCHIVEMAGIC.get(self.map[:2]) or _ARCHIVEMAGIC.get(self.map[:4])
+        if self.compression is None:
+            self.close()
+            raise ValueError("not an archive file: %r" % path)
+        elif self.compression == "zstd" and zstandard is None:
+            self.close()
+            raise ValueError("zstd compression needs the zstandard module")
+        self.times, self.positions = _readindex(path + ".idx", self.size)
+
+    def seek(self, start=None):
+        """Return the position of the first frame that may hold records newer than *start*."""
+        if start is None:
+            return 0
+        i = bisect.bisect_left(self.times, start)
+        return self.positions[i - 1] if i else 0
+
+    def decompressor(self):
+        if self.compression == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def frames(self, position=0):
+        """Generate the decompressed frames from *position* on."""
+        while position < self.size:
+            decompressor = self.decompressor()
+            chunks = []
+            while position < self.size and not decompressor.unused_data:
+                chunk = self.map[position:position + self.chunksize]
+                position += len(chunk)
+                try:
+                    chunks.append(decompressor.decompress(chunk))
+                except Exception:
+                    # A partly written frame may be corrupt, too.
+                    yield b"".join(chunks)
+                    return
+            position -= len(decompressor.unused_data)
+            yield b"".join(chunks)
+
+    def records(self, pid=None, stream=None, start=None, end=None):
+        position = self.seek(start)
+        first = not position
+        for frame in self.frames(position):
+            begin = 0
+            if first:
+                if frame[:len(_CAPTUREMAGIC)] != _CAPTUREMAGIC:
+                    raise ValueError("not an archive file: %r" % self.path)
+                begin = len(_CAPTUREMAGIC)
+                first = False
+            for record in _capturerecords(frame, memoryview(frame), begin, len(frame),
+                    pid, stream, start, end):
+                if record is None:
+                    return
+                yield record
+
+def asyncreader(reader):
+    """Wrap a coroutine reader method of a wrapped stream.
+
+    Like :func:`reader`, but *reader* is a coroutine method (eg of an
+    :class:`asyncio.StreamReader`), and so is the wrapper. Data is passed to
+    the wrapped stream's *logread* method before it is returned; at EOF, the
+    stream is finished (see :meth:`LoggingFile.finish`).
+    """
+    async def wrapper(self, *args):
+        data = await getattr(self.fd, reader)(*args)
+        self.logread(data)
+        if self.fd.at_eof():
+            self.finish()
+        return data
+    return wrapper
+
+class AsyncLoggingFile(LoggingFile):
+    """Intercept and log IO on :mod:`asyncio` streams.
+
+    Reads from an :class:`asyncio.StreamReader` and writes to an
+    :class:`asyncio.StreamWriter` are logged through :meth:`LoggingFile.log`.
+    The reader methods are coroutines, like the stream's own; wrappers also
+    support ``async for``.
+    """
+    readers = ("read", "readline", "readexactly", "readuntil")
+    writers = ("write", "writelines")
+
+    def write(self, data, *args, **kwargs):
+        self.logwrite(data, *args, **kwargs)
+        return self.fd.write(data)
+
+    def writelines(self, data, *args, **kwargs):
+        for chunk in data:
+            self.logwrite(chunk, *args, **kwargs)
+        return self.fd.writelines(data)
+
+    def close(self):
+        """Close the stream, after :meth:`finish`.
+
+        An :class:`asyncio.StreamReader` has no *close* method; readers are
+        finished when they reach EOF, and closing them only does that early.
+        """
+        try:
+            self.finish()
+        finally:
+            if hasattr(self.fd, "close"):
+                self.fd.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+for name in AsyncLoggingFile.readers:
+    setattr(AsyncLoggingFile, name, asyncreader(name))
+
+class AsyncLoggingCmd(_CmdStreams):
+    """An :mod:`asyncio` subprocess that logs its IO.
+
+    The asynchronous counterpart of :class:`LoggingCmd`, built on
+    :func:`asyncio.create_subprocess_exec`. Processes should be started with
+    :meth:`create`::
+
+        cmd = await AsyncLoggingCmd.create(["/bin/ls", "./tmp"], logger)
+        stdout, stderr = await cmd.communicate()
+
+    The process' streams are wrapped just like :class:`LoggingCmd`'s (see
+    :attr:`fdnames` and :attr:`wrapper`); other attributes, like
+    *returncode* and :meth:`wait`, come from the underlying
+    :class:`asyncio.subprocess.Process`.
+    """
+    wrapper = AsyncLoggingFile
+    """Wrapper class for the process' streams."""
+    rawio = False
+    """asyncio streams can't be wrapped with :func:`wrapraw`."""
+
+    def __init__(self, process, logger, args=None, options=None, fdoptions=None):
+        self.process = process
+        self.pid = process.pid
+        self.logger = logger
+        self.args = args
+        for fdname in self.fdnames:
+            setattr(self, fdname, getattr(process, fdname))
+        if options is not None:
+            self.options = options
+        if fdoptions is not None:
+            self.fdoptions = fdoptions
+        self.wrapfds()
+
+    @classmethod
+    async def create(cls, args, logger, options=None, fdoptions=None, **kwargs):
+        """Start a process.
+
+        Arguments are as for :class:`LoggingCmd`; *kwargs* are passed on to
+        :func:`asyncio.create_subprocess_exec`. Returns an
+        :class:`AsyncLoggingCmd` instance.
+        """
+        _kwargs = kwargs.copy()
+        for fdname in cls.fdnames:
+            _kwargs[fdname] = PIPE
+        process = await asyncio.create_subprocess_exec(*args, **_kwargs)
+        return cls(process, logger, args, options, fdoptions)
+
+    def __getattr__(self, name):
+        if name == "process":
+            raise AttributeError(name)
+        return getattr(self.process, name)
+
+    async def communicate(self, input=None):
+        """Interact with the process and wait for it to terminate.
+
+        Like :meth:`asyncio.subprocess.Process.communicate`, but data is passed
+        through the logging wrappers. Returns a (stdout, stderr) tuple.
+        """
+        async def feed(stdin):
+            if input:
+                stdin.write(input)
+            try:
+                await stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            stdin.close()
+
+        async def read(wrapped):
+            return None if wrapped is None else await wrapped.read()
+
+        coros = [read(self.stdout), read(self.stderr), self.process.wait()]
+        if self.stdin is not None:
+            coros.append(feed(self.stdin))
+        results = await asyncio.gather(*coros)
+        return tuple(results[:2])
@@ -1,6 +1,10 @@
+import asyncio
+import logging
+import os
+import sys
 import unittest
 
-from StringIO import StringIO
+from io import StringIO
 
 class FakeWrapper(object):
     readers = ("areader",)
@@ -13,6 +17,8 @@ class FakeWrapper(object):
     def log(self, str, *args, **kwargs):
         self.logs.append((str, args, kwargs))
 
+    logread = logwrite = log
+
 class FakeFile(object):
     foo = "foo"
     areader = "untouched"
@@ -40,7 +46,36 @@ class FakeLogger(object):
         self.logs = []
 
     def log(self, level, msg, *args, **kwargs):
-        self.logs.append((level, msg, args, kwargs))
+        # Render the message like a handler would.
+        self.logs.append((level, str(msg), args, kwargs))
+
+class FakeLevelLogger(FakeLogger):
+
+    def __init__(self, level):
+        FakeLogger.__init__(self)
+        self.level = level
+        self.checks = 0
+
+    def isEnabledFor(self, level):
+        self.checks += 1
+        return level >= self.level
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def listlogger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.handlers = [handler]
+    return logger, handler
 
 class TestUtils(unittest.TestCase):
 
@@ -54,6 +89,33 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(wrapped.foo, "foo")
         self.assertEqual(wrapped.areader, "untouched")
 
+    def test_wrapfd_delegate(self):
+        import io
+        from prociolog import LineLoggingFile, wrapfd
+
+        fd = FakeFile()
+        wrapped = wrapfd(fd, FakeLogger(), LineLoggingFile)
+
+        self.assertEqual(wrapped.foo, "foo")
+        self.assertFalse("foo" in wrapped.__dict__)
+        fd.foo = "bar"
+        self.assertEqual(wrapped.foo, "bar")
+        self.assertRaises(AttributeError, getattr, wrapped, "nosuchattr")
+
+        # Decoding options don't hide the file object's attributes.
+        text = io.TextIOWrapper(io.BytesIO(), encoding="latin-1")
+        decoded = wrapfd(text, FakeLogger(), LineLoggingFile, logencoding="utf-8")
+        self.assertEqual((decoded.encoding, decoded.errors), ("latin-1", "strict"))
+
+        buf = io.BytesIO(b"foobar")
+        self.assertEqual(wrapfd(buf, FakeLogger(), LineLoggingFile).truncate(3), 3)
+        self.assertEqual(buf.getvalue(), b"foo")
+
+        # The wrapper's own methods aren't shadowed by the file object's.
+        wrapped.write("partial")
+        wrapped.close()
+        self.assertEqual(wrapped.logger.logs[0][1], repr("partial"))
+
     def test_reader(self):
         from prociolog import reader
 
@@ -148,16 +210,416 @@ class TestLoggingFile(unittest.TestCase):
         self.assertEqual(len(logger.logs), 1)
         self.assertEqual(logger.logs[0], (20, repr(msg), ("arg",), {"foo": "bar"}))
 
+    def test_log_disabled(self):
+        loggingfile = self.instance()
+        logger = loggingfile.logger = FakeLevelLogger(20)
+
+        loggingfile.log("a message")
+        loggingfile.log("another message")
+        self.assertEqual(len(logger.logs), 0)
+        self.assertEqual(logger.checks, 1)
+
+        loggingfile.log("a message", level=30)
+        self.assertEqual(len(logger.logs), 1)
+        self.assertEqual(logger.checks, 2)
+
+    def test_readinto(self):
+        import io
+        from prociolog import LoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LoggingFile(io.BufferedReader(io.BytesIO(b"foo bar baz")), logger)
+        buf = bytearray(4)
+        self.assertEqual(loggingfile.readinto(buf), 4)
+        self.assertEqual(bytes(buf), b"foo ")
+        self.assertEqual(loggingfile.peek(1)[:1], b"b")
+        self.assertEqual(loggingfile.readinto(memoryview(buf)[:2]), 2)
+        self.assertEqual(loggingfile.read1(3), b"r b")
+        self.assertEqual(loggingfile.readinto(buf), 2)
+        self.assertEqual(loggingfile.readinto(buf), 0)
+
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo "), repr(b"ba"), repr(b"r b"), repr(b"az")])
+
+    def test_readinto_dispatcher(self):
+        import io
+        from prociolog import Dispatcher, LoggingFile
+
+        logger, handler = listlogger("tests.readinto")
+        dispatcher = Dispatcher()
+        loggingfile = LoggingFile(io.BytesIO(b"foobar"), logger,
+            dispatcher=dispatcher)
+        buf = bytearray(3)
+        loggingfile.readinto(buf)
+        loggingfile.readinto(buf)
+        dispatcher.close()
+
+        # The buffer was reused, but each record kept what was read.
+        self.assertEqual([r.getMessage() for r in handler.records],
+            [repr(b"foo"), repr(b"bar")])
+
+    def test_iter(self):
+        import io
+        from prociolog import LoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LoggingFile(io.BytesIO(b"foo\nbar\n"), logger)
+        self.assertEqual(list(loggingfile), [b"foo\n", b"bar\n"])
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo\n"), repr(b"bar\n")])
+
+    def test_subscribe(self):
+        import io
+        from prociolog import LoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LoggingFile(io.BytesIO(b"foo\nbar\nbaz\n"), logger,
+            extra={"stream": "stdout"})
+        calls = []
+        callback = loggingfile.subscribe(lambda *args: calls.append(args))
+        queued = loggingfile.subscribe(maxsize=2)
+        failing = loggingfile.subscribe(lambda *args: 1 / 0)
+        buf = bytearray(4)
+        for i in range(3):
+            loggingfile.readinto(buf)
+        loggingfile.read()
+
+        self.assertEqual(calls, [("stdout", b"foo\n"), ("stdout", b"bar\n"),
+            ("stdout", b"baz\n")])
+        self.assertEqual((queued.received, queued.dropped, failing.errors), (3, 1, 3))
+        self.assertEqual(queued.get(), ("stdout", b"bar\n"))
+        # Buffers are copied once, for every subscriber.
+        self.assertTrue(queued.get()[1] is calls[2][1])
+        self.assertEqual(queued.get(timeout=0.01), None)
+        self.assertFalse(queued.closed)
+        loggingfile.close()
+        self.assertTrue(queued.closed and callback.closed)
+        self.assertEqual(list(queued), [])
+        self.assertTrue(loggingfile.subscribe().closed)
+        self.assertEqual(len(logger.logs), 4)
+
+    def test_wrapraw(self):
+        import io
+        from prociolog import LineLoggingFile, LoggingRawIO, wrapraw
+
+        reader, writer = os.pipe()
+        logger = FakeLogger()
+        source = wrapraw(io.open(writer, "wb"), logger, LineLoggingFile)
+        sink = wrapraw(io.FileIO(reader, "r"), logger, LineLoggingFile)
+        self.assertTrue(isinstance(sink, io.BufferedReader))
+        self.assertTrue(isinstance(source.raw, LoggingRawIO))
+        self.assertTrue(isinstance(sink.raw.wrapped, LineLoggingFile))
+        source.write(b"foo\n")
+        source.write(b"bar\nbaz")
+        # Nothing is logged until the buffer reaches the raw file.
+        self.assertEqual(logger.logs, [])
+        source.close()
+        self.assertEqual(sink.readline(), b"foo\n")
+        self.assertEqual(list(sink), [b"bar\n", b"baz"])
+        sink.close()
+
+        self.assertTrue(sink.raw.wrapped.fd.closed)
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo\n"), repr(b"bar\n"), repr(b"baz")] * 2)
+
+    def test_log_encoding(self):
+        from prociolog import HeadPolicy, LoggingFile
+
+        logger, handler = listlogger("tests.encoding")
+        loggingfile = LoggingFile(FakeFile(), logger, logencoding="utf-8",
+            policy=HeadPolicy(3))
+        loggingfile.log(b"caf\xc3")
+        loggingfile.log(b"\xa9!\n")
+        loggingfile.log(b"\xe2\x82")
+        loggingfile.log(b"\xac")
+        loggingfile.log(b"\xff")
+
+        self.assertEqual([r.msg.text() for r in handler.records],
+            ["caf", "\xe9!", ""])
+        # The suppressed record's half of the character was forgotten.
+        self.assertEqual(loggingfile.decoder.decode(b"x"), "x")
+
+    def test_log_lazy(self):
+        from prociolog import LazyRepr
+
+        class Data(object):
+            renders = 0
+            def __repr__(self):
+                self.renders += 1
+                return "data"
+
+        loggingfile = self.instance()
+        logger = loggingfile.logger
+        logger.log = lambda level, msg, *args, **kwargs: logger.logs.append(msg)
+        data = Data()
+        loggingfile.log(data)
+
+        self.assertTrue(isinstance(logger.logs[0], LazyRepr))
+        self.assertEqual(data.renders, 0)
+        self.assertEqual(str(logger.logs[0]), "data")
+        self.assertEqual(data.renders, 1)
+
+    def test_levelchange(self):
+        from prociolog import LoggingFile
+
+        logger, handler = listlogger("tests.levelchange")
+        logger.setLevel(logging.INFO)
+        first = LoggingFile(FakeFile(), logger)
+        self.assertFalse(first.enabledfor(logging.DEBUG))
+
+        # Level changes are seen by new and existing wrappers alike.
+        logger.setLevel(logging.DEBUG)
+        self.assertTrue(first.enabledfor(logging.DEBUG))
+        self.assertTrue(LoggingFile(FakeFile(), logger).enabledfor(logging.DEBUG))
+        logger.setLevel(logging.WARNING)
+        second = LoggingFile(FakeFile(), logger)
+        self.assertFalse(second.enabledfor(logging.DEBUG))
+        second.log(b"foo")
+        second.emit(logging.DEBUG, "bar", (), {})
+        self.assertEqual(handler.records, [])
+
+    def test_options(self):
+        from prociolog import LoggingFile
+
+        loggingfile = LoggingFile(FakeFile(), FakeLogger(), level=20)
+        self.assertEqual(loggingfile.level, 20)
+        self.assertEqual(LoggingFile.level, logging.DEBUG)
+        self.assertRaises(TypeError, LoggingFile, FakeFile(), FakeLogger(),
+            nosuchoption=1)
+
+    def test_log_dispatcher(self):
+        from prociolog import Dispatcher
+
+        loggingfile = self.instance()
+        loggingfile.dispatcher = dispatcher = Dispatcher()
+        data = bytearray(b"a message")
+        loggingfile.log(data, level=20)
+        data[:] = b"changed"
+        dispatcher.close()
+
+        logger = loggingfile.logger
+        self.assertEqual(logger.logs, [(20, repr(b"a message"), (), {})])
+        self.assertEqual(dispatcher.emitted, 1)
+
+    def test_own_dispatcher(self):
+        import io
+        from prociolog import Dispatcher, LoggingFile
+
+        shared = Dispatcher()
+        loggingfile = LoggingFile(io.BytesIO(b"foo"), FakeLogger(),
+            dispatcher=shared)
+        loggingfile.close()
+        self.assertFalse(shared.closed)
+        shared.close()
+
+        logger = FakeLogger()
+        loggingfile = LoggingFile(io.BytesIO(b"foo"), logger, dispatcher=True)
+        loggingfile.read()
+        thread = loggingfile.dispatcher.thread
+        loggingfile.close()
+        self.assertTrue(loggingfile.dispatcher.closed)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(logger.logs, [(logging.DEBUG, repr(b"foo"), (), {})])
+
+    def test_log_maxrecord(self):
+        import hashlib
+
+        loggingfile = self.instance()
+        loggingfile.maxrecord = 8
+        loggingfile.previewhead = loggingfile.previewtail = 3
+        logs = loggingfile.logger.logs
+
+        loggingfile.log(b"short")
+        data = b"a long message"
+        loggingfile.log(data, extra={"foo": "bar"})
+
+        self.assertEqual(logs[0][1], repr(b"short"))
+        self.assertEqual(logs[1][1], "%r ... %r" % (b"a l", b"age"))
+        self.assertEqual(logs[1][3], {"extra": {"foo": "bar", "length": len(data),
+            "truncated": True, "digest": hashlib.sha1(data).hexdigest()}})
+
+    def test_log_maxrecord_nocopy(self):
+        loggingfile = self.instance()
+        loggingfile.maxrecord = 8
+        loggingfile.previewhead = loggingfile.previewtail = 3
+        logger = loggingfile.logger
+        logger.log = lambda level, msg, *args, **kwargs: logger.logs.append(msg)
+
+        data = bytearray(b"a long message")
+        loggingfile.log(data)
+        preview = logger.logs[0]
+        data[:3] = b"XXX"
+        self.assertEqual(str(preview), "%r ... %r" % (b"XXX", b"age"))
+
+    def test_log_maxstream(self):
+        loggingfile = self.instance()
+        loggingfile.maxstream = 10
+        logs = loggingfile.logger.logs
+
+        for msg in ("12345", "123456", "1234", "12"):
+            loggingfile.log(msg)
+        self.assertEqual([log[1] for log in logs], [repr("12345"), repr("1234")])
+        self.assertEqual((loggingfile.suppressed, loggingfile.suppressedbytes), (2, 8))
+
+        loggingfile.close()
+        self.assertEqual(logs[2], (loggingfile.level, "suppressed %d records (%d bytes)",
+            (2, 8), {"extra": {"suppressed": 2, "suppressedbytes": 8}}))
+
+    def test_log_policy(self):
+        from prociolog import SamplePolicy
+
+        loggingfile = self.instance()
+        loggingfile.policy = SamplePolicy(3)
+        logs = loggingfile.logger.logs
+
+        for i in range(7):
+            loggingfile.log(str(i))
+        self.assertEqual([log[1] for log in logs], [repr("0"), repr("3"), repr("6")])
+        self.assertEqual(loggingfile.suppressed, 4)
+
+        loggingfile.close()
+        self.assertEqual(logs[-1][3], {"extra": {"suppressed": 4, "suppressedbytes": 4}})
+
+class TestPolicies(unittest.TestCase):
+
+    def allowed(self, policy, count):
+        return [i for i in range(count) if policy.allow(str(i))]
+
+    def test_sample(self):
+        from prociolog import SamplePolicy
+
+        self.assertEqual(self.allowed(SamplePolicy(4), 10), [0, 4, 8])
+        self.assertEqual(self.allowed(SamplePolicy(1), 3), [0, 1, 2])
+
+    def test_rate_limit(self):
+        from prociolog import RateLimitPolicy
+
+        now = [0.0]
+        policy = RateLimitPolicy(2, burst=3, clock=lambda: now[0])
+        self.assertEqual(self.allowed(policy, 5), [0, 1, 2])
+        now[0] += 1
+        self.assertEqual(self.allowed(policy, 5), [0, 1])
+        now[0] += 10
+        self.assertEqual(self.allowed(policy, 5), [0, 1, 2])
+
+    def test_head(self):
+        from prociolog import HeadPolicy
+
+        self.assertEqual(self.allowed(HeadPolicy(2, 3), 10), [0, 1, 4, 7])
+        self.assertEqual(self.allowed(HeadPolicy(2), 10), [0, 1])
+
+class BlockingLogger(FakeLogger):
+    """A logger that blocks in log() until released."""
+
+    def __init__(self):
+        import threading
+
+        FakeLogger.__init__(self)
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def log(self, level, msg, *args, **kwargs):
+        self.entered.set()
+        self.released.wait()
+        FakeLogger.log(self, level, msg, *args, **kwargs)
+
+class TestDispatcher(unittest.TestCase):
+
+    def fill(self, dispatcher, count):
+        # Park the dispatcher thread on the first record, then fill the queue.
+        logger = BlockingLogger()
+        dispatcher.put(logger, 10, "0")
+        logger.entered.wait()
+        for i in range(1, count):
+            dispatcher.put(logger, 10, str(i))
+        logger.released.set()
+        dispatcher.close()
+        return [log[1] for log in logger.logs]
+
+    def test_block(self):
+        from prociolog import Dispatcher
+
+        dispatcher = Dispatcher(maxsize=2)
+        logger = BlockingLogger()
+        logger.released.set()
+        for i in range(10):
+            dispatcher.put(logger, 10, str(i))
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([log[1] for log in logger.logs], [str(i) for i in range(10)])
+        self.assertEqual((dispatcher.queued, dispatcher.emitted, dispatcher.dropped),
+            (10, 10, 0))
+        dispatcher.close()
+
+    def test_drop_oldest(self):
+        from prociolog import Dispatcher
+
+        dispatcher = Dispatcher(maxsize=2, policy="drop-oldest")
+        logs = self.fill(dispatcher, 6)
+        self.assertEqual(logs, ["0", "4", "5"])
+        self.assertEqual(dispatcher.dropped, 3)
+
+    def test_sample(self):
+        from prociolog import Dispatcher
+
+        dispatcher = Dispatcher(maxsize=2, policy="sample", samplerate=2)
+        logs = self.fill(dispatcher, 7)
+        self.assertEqual(logs, ["0", "4", "6"])
+        self.assertEqual(dispatcher.dropped, 4)
+
+    def test_bad_policy(self):
+        from prociolog import Dispatcher
+
+        self.assertRaises(ValueError, Dispatcher, policy="nope")
+
+    def test_closed(self):
+        from prociolog import Dispatcher
+
+        dispatcher = Dispatcher()
+        dispatcher.close()
+        self.assertRaises(ValueError, dispatcher.put, FakeLogger(), 10, "msg")
+
+    def test_closed_while_blocked(self):
+        import threading
+        import time
+        from prociolog import Dispatcher
+
+        dispatcher = Dispatcher(maxsize=1)
+        logger = BlockingLogger()
+        dispatcher.put(logger, 10, "0")
+        logger.entered.wait()
+        dispatcher.put(logger, 10, "1")
+        errors = []
+        def put():
+            try:
+                dispatcher.put(logger, 10, "2")
+            except ValueError as e:
+                errors.append(e)
+        producer = threading.Thread(target=put)
+        producer.start()
+        # Give the producer time to block on the full queue.
+        time.sleep(0.05)
+        closer = threading.Thread(target=dispatcher.close)
+        closer.start()
+        while not dispatcher.closed:
+            time.sleep(0.001)
+        logger.released.set()
+        producer.join()
+        closer.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual([log[1] for log in logger.logs], ["0", "1"])
+        self.assertTrue(dispatcher.flush(1))
+
 class TestLineLoggingFile(unittest.TestCase):
 
-    def instance(self):
+    def instance(self, **options):
         from prociolog import LineLoggingFile
 
         logger = FakeLogger()
         fd = FakeFile()
         fd.data = """foo\nbar\nbaz\n"""
-        fd.buffer.buf = fd.data
-        return LineLoggingFile(fd, logger)
+        fd.buffer = StringIO(fd.data)
+        return LineLoggingFile(fd, logger, **options)
 
     def test_read(self):
         loggingfile = self.instance()
@@ -168,10 +630,212 @@ class TestLineLoggingFile(unittest.TestCase):
         self.assertEqual(len(logger.logs), 3)
         self.assertEqual(logger.logs[0], (loggingfile.level, repr("foo\n"), (), {}))
 
+    def test_readinto(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LineLoggingFile(io.BytesIO(b"foo\nbar\nbaz"), logger,
+            newline=b"\n")
+        buf = bytearray(6)
+        while loggingfile.readinto(buf):
+            pass
+        loggingfile.close()
+
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo\n"), repr(b"bar\n"), repr(b"baz")])
+
+        # Lines split across reads into a reused buffer, with \r\n newlines.
+        logger = FakeLogger()
+        loggingfile = LineLoggingFile(io.BytesIO(b"ab\r\ncd\r\nef\r"), logger,
+            newline=b"\r\n")
+        buf = bytearray(3)
+        while loggingfile.readinto(buf):
+            pass
+        loggingfile.close()
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"ab\r\n"), repr(b"cd\r\n"), repr(b"ef\r")])
+        self.assertEqual(loggingfile.readbuf.count(memoryview(b"a\r\nb\r\n")), 2)
+
+    def test_readinto_disabled(self):
+        import io
+        import tracemalloc
+        from prociolog import LineLoggingFile
+
+        logger = FakeLevelLogger(logging.INFO)
+        loggingfile = LineLoggingFile(io.BytesIO((b"x" * 99 + b"\n") * 20000),
+            logger, newline=b"\n")
+        buf = bytearray(1 << 20)
+        tracemalloc.start()
+        try:
+            while loggingfile.readinto(buf):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        # Nothing close to the size of a chunk was allocated.
+        self.assertTrue(peak < 1 << 16, peak)
+        self.assertEqual(logger.logs, [])
+
+    def test_readline(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LineLoggingFile(io.BytesIO(b"foo\nbar\nbaz"), logger,
+            newline=b"\n")
+        self.assertEqual(loggingfile.readline(2), b"fo")
+        self.assertEqual(loggingfile.readline(), b"o\n")
+        self.assertEqual(loggingfile.readlines(), [b"bar\n", b"baz"])
+        self.assertEqual(loggingfile.readline(), b"")
+        loggingfile.close()
+
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo\n"), repr(b"bar\n"), repr(b"baz")])
+
+    def test_iter(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        logger = FakeLogger()
+        loggingfile = LineLoggingFile(io.BytesIO(b"foo\r\nbar\nbaz\r\n"), logger,
+            newline=b"\r\n")
+        self.assertEqual(next(loggingfile), b"foo\r\n")
+        self.assertEqual(list(loggingfile), [b"bar\n", b"baz\r\n"])
+
+        self.assertEqual([log[1] for log in logger.logs],
+            [repr(b"foo\r\n"), repr(b"bar\nbaz\r\n")])
+
+    def test_read_encoding(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        logger, handler = listlogger("tests.encoding")
+        loggingfile = LineLoggingFile(io.BytesIO("na\xefve\nr\xe9sum\xe9\n".encode("utf-8")),
+            logger, newline=b"\n", logencoding="utf-8")
+        while loggingfile.read(3):
+            pass
+
+        records = handler.records
+        self.assertEqual([r.msg.data for r in records],
+            [b"na\xc3\xafve\n", b"r\xc3\xa9sum\xc3\xa9\n"])
+        self.assertEqual([r.msg.text() for r in records],
+            ["na\xefve", "r\xe9sum\xe9"])
+
+    def test_metrics(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        loggingfile = LineLoggingFile(io.BytesIO(b"foo\nbar\nbazzzz\n"), FakeLogger(),
+            newline=b"\n", metrics=True)
+        metrics = loggingfile.metrics
+        metrics.started = 0.0
+        metrics.clock = lambda: 10.0
+        while loggingfile.read(5):
+            pass
+        loggingfile.write(b"quux\n")
+        loggingfile.close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot["reads"], snapshot["readbytes"],
+            snapshot["readlines"]), (4, 15, 3))
+        self.assertEqual((snapshot["writes"], snapshot["writebytes"],
+            snapshot["writelines"]), (1, 5, 1))
+        self.assertEqual(snapshot["maxbuffered"], 2)
+        self.assertEqual(snapshot["buffered"], 0)
+        self.assertTrue(snapshot["maxlogtime"] > 0)
+        self.assertEqual(snapshot["elapsed"], 10.0)
+        self.assertEqual(snapshot["readbytespersec"], 1.5)
+
+    def test_rules(self):
+        import io
+        from prociolog import LineLoggingFile, RuleSet
+
+        data = b"ok 1\nERROR 2\nok 3\nok 4\nok 5\nOOM 6\nok 7"
+        logger, handler = listlogger("tests.rules")
+        rules = RuleSet([("ERROR|OOM", logging.WARNING)], default=None)
+        loggingfile = LineLoggingFile(io.BytesIO(data), logger, rules=rules)
+        while loggingfile.read(4):
+            pass
+        loggingfile.close()
+        self.assertEqual([(r.levelno, r.msg.data) for r in handler.records],
+            [(logging.WARNING, b"ERROR 2\n"), (logging.WARNING, b"OOM 6\n")])
+
+        logger, handler = listlogger("tests.rules.batch")
+        rules = RuleSet([("ERROR|OOM", logging.WARNING)])
+        loggingfile = LineLoggingFile(io.BytesIO(data), logger, rules=rules,
+            batchlines=2)
+        loggingfile.read()
+        loggingfile.close()
+        self.assertEqual([(r.levelno, r.msg.data) for r in handler.records],
+            [(logging.DEBUG, b"ok 1\n"), (logging.WARNING, b"ERROR 2\n"),
+            (logging.DEBUG, b"ok 3\nok 4\n"), (logging.DEBUG, b"ok 5\n"),
+            (logging.WARNING, b"OOM 6\n"), (logging.DEBUG, b"ok 7")])
+
+        # Nothing is matched unless a level the rules choose is enabled.
+        fail = self.fail
+        class UnusedRuleSet(RuleSet):
+            def search(self, data):
+                fail("searched %r" % data)
+            def level(self, line):
+                fail("matched %r" % line)
+
+        logger.setLevel(logging.ERROR)
+        rules = UnusedRuleSet([("ERROR|OOM", logging.WARNING)])
+        loggingfile = LineLoggingFile(io.BytesIO(data), logger, rules=rules)
+        loggingfile.read()
+        self.assertEqual(len(handler.records), 6)
+
+    def test_tail(self):
+        import io
+        from prociolog import LineLoggingFile, RingBuffer, RuleSet
+
+        logger, handler = listlogger("tests.tail")
+        loggingfile = LineLoggingFile(io.BytesIO(b"".join(b"line %d\n" % i
+            for i in range(100))), logger, tail=RingBuffer(100, lines=3))
+        while loggingfile.read(7):
+            pass
+        self.assertEqual(handler.records, [])
+        loggingfile.dumptail(extra=dict(reason="test"))
+        self.assertEqual([r.msg.data for r in handler.records],
+            [b"line 97\n", b"line 98\n", b"line 99\n"])
+        self.assertEqual(handler.records[0].dropped, 690)
+        self.assertEqual(handler.records[0].reason, "test")
+        loggingfile.dumptail()
+        self.assertEqual(len(handler.records), 3)
+
+        # Lines the rules raise to an enabled level are kept.
+        logger.setLevel(logging.INFO)
+        rules = RuleSet([("ERROR", logging.WARNING)])
+        loggingfile = LineLoggingFile(io.BytesIO(b"ok\nERROR boom\n"), logger,
+            rules=rules, tail=1024)
+        loggingfile.read()
+        loggingfile.dumptail()
+        self.assertEqual([(r.levelno, r.msg.data) for r in handler.records[3:]],
+            [(logging.WARNING, b"ERROR boom\n")])
+
+    def test_read_maxline(self):
+        import io
+        from prociolog import LineLoggingFile
+
+        logger, handler = listlogger("tests.maxline")
+        loggingfile = LineLoggingFile(io.BytesIO(b"x" * 100 + b"\nend\r1\r2"),
+            logger, newline=b"\n", cr=True, maxline=10, overflow="truncate")
+        while loggingfile.read(7):
+            pass
+        loggingfile.close()
+
+        records = handler.records
+        self.assertEqual([r.msg.data for r in records],
+            [b"x" * 10, b"end\r", b"1\r", b"2"])
+        self.assertEqual((records[0].length, records[0].truncated), (101, True))
+        self.assertEqual(records[-1].onclose, "read")
+
     def test_read_empty(self):
         loggingfile = self.instance()
         loggingfile.fd.data = ""
-        loggingfile.fd.buffer.buf = loggingfile.fd.data
+        loggingfile.fd.buffer = StringIO(loggingfile.fd.data)
         result = loggingfile.read()
         logger = loggingfile.logger
 
@@ -190,7 +854,7 @@ class TestLineLoggingFile(unittest.TestCase):
     def test_read_no_newline_at_end(self):
         loggingfile = self.instance()
         loggingfile.fd.data = loggingfile.fd.data.strip()
-        loggingfile.fd.buffer.buf = loggingfile.fd.data
+        loggingfile.fd.buffer = StringIO(loggingfile.fd.data)
         result = loggingfile.read()
         logger = loggingfile.logger
 
@@ -201,12 +865,11 @@ class TestLineLoggingFile(unittest.TestCase):
         result = loggingfile.read()
         self.assertEqual(result, "")
         self.assertEqual(len(logger.logs), 0)
-        self.assertEqual(len(loggingfile.readbuf), 1)
-        self.assertEqual(loggingfile.readbuf[0], "baz")
+        self.assertEqual(loggingfile.readbuf.getvalue(), "baz")
 
     def test_read_readbuf(self):
         loggingfile = self.instance()
-        loggingfile.readbuf.append("a partial read")
+        list(loggingfile.readbuf.lines("a partial read"))
         logs = loggingfile.logger.logs
 
         result = loggingfile.read()
@@ -218,8 +881,8 @@ class TestLineLoggingFile(unittest.TestCase):
     def test_close(self):
         loggingfile = self.instance()
         logger = loggingfile.logger
-        loggingfile.writebuf.append("a partial write")
-        loggingfile.readbuf.append("a partial read")
+        list(loggingfile.writebuf.lines("a partial write"))
+        list(loggingfile.readbuf.lines("a partial read"))
 
         loggingfile.close()
 
@@ -241,7 +904,7 @@ class TestLineLoggingFile(unittest.TestCase):
 
     def test_write_writebuf(self):
         loggingfile = self.instance()
-        loggingfile.writebuf.append("a partial write")
+        list(loggingfile.writebuf.lines("a partial write"))
         logs = loggingfile.logger.logs
 
         result = loggingfile.write("the rest of a write\n")
@@ -259,8 +922,7 @@ class TestLineLoggingFile(unittest.TestCase):
         loggingfile.writelines("foo bar baz".split())
 
         self.assertEqual(len(logs), 0)
-        self.assertEqual(len(loggingfile.writebuf), 1)
-        self.assertEqual(loggingfile.writebuf[0], "foobarbaz")
+        self.assertEqual(loggingfile.writebuf.getvalue(), "foobarbaz")
 
     def test_writelines_empty(self):
         loggingfile = self.instance()
@@ -271,6 +933,959 @@ class TestLineLoggingFile(unittest.TestCase):
         self.assertEqual(len(logs), 0)
         self.assertEqual(len(loggingfile.writebuf), 0)
 
+    def test_read_disabled(self):
+        loggingfile = self.instance()
+        logger = loggingfile.logger = FakeLevelLogger(20)
+
+        loggingfile.read(5)
+        self.assertEqual(loggingfile.readbuf.getvalue(), "b")
+        loggingfile.read(6)
+        self.assertEqual(loggingfile.readbuf.getvalue(), "baz")
+        self.assertEqual(len(logger.logs), 0)
+
+    def test_batchlines(self):
+        loggingfile = self.instance(batchlines=2)
+        logs = loggingfile.logger.logs
+
+        loggingfile.read()
+        self.assertEqual(logs, [
+            (loggingfile.level, repr("foo\nbar\n"), (), {"extra": {"lines": 2}})])
+
+        loggingfile.close()
+        self.assertEqual(logs[1],
+            (loggingfile.level, repr("baz\n"), (), {"extra": {"onclose": "read", "lines": 1}}))
+
+    def test_batchbytes(self):
+        from prociolog import LineLoggingFile
+
+        loggingfile = LineLoggingFile(FakeFile(), FakeLogger(), batchbytes=12)
+        logs = loggingfile.logger.logs
+
+        loggingfile.read()
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0][1], repr("fake data\nmore fake data\n"))
+        self.assertEqual(logs[0][3]["extra"]["lines"], 2)
+
+    def test_batchtime(self):
+        from prociolog import LineLoggingFile
+
+        loggingfile = LineLoggingFile(FakeFile(), FakeLogger(), batchtime=0)
+        logs = loggingfile.logger.logs
+
+        loggingfile.write("foo\nbar\nba")
+        self.assertEqual(logs, [(loggingfile.level, repr("foo\nbar\n"), (),
+            {"extra": {"lines": 2}})])
+        self.assertEqual(loggingfile.writebuf.getvalue(), "ba")
+
+    def test_expire(self):
+        from prociolog import LineLoggingFile
+
+        loggingfile = LineLoggingFile(FakeFile(), FakeLogger(), batchtime=60)
+        logs = loggingfile.logger.logs
+        self.assertEqual(loggingfile.expire(), None)
+
+        loggingfile.write("foo\n")
+        started = loggingfile.writebatch.started
+        self.assertEqual(loggingfile.expire(), started + 60)
+        self.assertEqual(logs, [])
+        loggingfile.writebatch.started -= 60
+        self.assertEqual(loggingfile.expire(), None)
+        self.assertEqual(logs, [(loggingfile.level, repr("foo\n"), (),
+            {"extra": {"lines": 1}})])
+
+class TestLineBuffer(unittest.TestCase):
+
+    def test_lines(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer()
+        self.assertEqual(list(buf.lines(b"foo\nba")), [b"foo\n"])
+        self.assertEqual(list(buf.lines(b"r")), [])
+        self.assertEqual(list(buf.lines(b"\nbaz\n\nq")), [b"bar\n", b"baz\n", b"\n"])
+        self.assertEqual(len(buf), 1)
+        self.assertEqual(buf.flush(), b"q")
+        self.assertEqual(len(buf), 0)
+
+    def test_lines_text(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer(b"\n")
+        self.assertEqual(list(buf.lines("foo\nba")), ["foo\n"])
+        self.assertEqual(list(buf.lines("r\n")), ["bar\n"])
+        self.assertEqual(buf.getvalue(), "")
+
+    def test_lines_newline(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer("\r\n")
+        lines = list(buf.lines(bytearray(b"foo\r\nbar\nbaz\r")))
+        self.assertEqual(lines, [b"foo\r\n"])
+        self.assertEqual(list(buf.lines(memoryview(b"\n"))), [b"bar\nbaz\r\n"])
+
+    def test_discard(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer()
+        buf.discard(b"foo")
+        buf.discard(b"bar\nbaz\nqu")
+        self.assertEqual(buf.getvalue(), b"qu")
+        self.assertEqual(list(buf.lines(b"ux\n")), [b"quux\n"])
+
+    def test_lines_cr(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer(cr=True)
+        self.assertEqual(list(buf.lines(b"10%\r20%\r")), [b"10%\r"])
+        self.assertEqual(list(buf.lines(b"\nfoo\r")), [b"20%\r\n"])
+        self.assertEqual(list(buf.lines(b"bar\n")), [b"foo\r", b"bar\n"])
+        self.assertEqual(buf.count(b"a\rb\r\nc\n"), 3)
+        self.assertEqual(len(buf), 0)
+
+    def test_maxline_flush(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer(maxline=4)
+        lines = []
+        for data in (b"fo", b"ooba", b"r\nbaz"):
+            for line in buf.lines(data):
+                lines.append((line, buf.info))
+        self.assertEqual(lines, [(b"foooba", {"partial": True}), (b"r\n", None)])
+        self.assertEqual(buf.getvalue(), b"baz")
+
+    def test_maxline_truncate(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer(maxline=4, overflow="truncate")
+        lines = []
+        for data in (b"fo", b"ooba", b"r\nbaz\n"):
+            for line in buf.lines(data):
+                lines.append((line, buf.info))
+        self.assertEqual(lines, [(b"fooo", {"length": 8, "truncated": True}),
+            (b"baz\n", None)])
+        self.assertEqual(len(buf), 0)
+
+    def test_maxline_split_newline(self):
+        from prociolog import LineBuffer
+
+        # A newline split between reads still ends a line that overflowed.
+        for overflow in ("truncate", "spill"):
+            buf = LineBuffer(b"\r\n", maxline=3, overflow=overflow)
+            self.assertEqual(list(buf.lines(b"abcde\r")), [])
+            lines = [(line, dict(buf.info or {}))
+                for line in buf.lines(b"\nnext line\r\n")]
+            self.assertEqual([line for line, info in lines], [b"abc", b"next line\r\n"])
+            self.assertEqual(lines[0][1]["length"], 7)
+            if overflow == "spill":
+                with open(lines[0][1]["spilled"], "rb") as f:
+                    self.assertEqual(f.read(), b"abcde\r\n")
+                os.remove(lines[0][1]["spilled"])
+
+    def test_maxline_spill(self):
+        from prociolog import LineBuffer
+
+        buf = LineBuffer(maxline=4, overflow="spill")
+        self.assertEqual(list(buf.lines(b"foooo")), [])
+        self.assertEqual(list(buf.lines(b"bar")), [])
+        self.assertEqual(len(buf), 4)
+        lines = [(line, dict(buf.info)) for line in buf.lines(b"\n")]
+        self.assertEqual([line for line, info in lines], [b"fooo"])
+        info = lines[0][1]
+        path = info.pop("spilled")
+        self.assertEqual(info, {"length": 9, "truncated": True})
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"foooobar\n")
+        os.remove(path)
+
+        buf.discard(b"foooo")
+        self.assertEqual((buf.spill, len(buf)), (None, 0))
+
+    def test_maxspills(self):
+        import tempfile
+        from prociolog import LineBuffer
+
+        spilldir = tempfile.mkdtemp()
+        buf = LineBuffer(maxline=2, overflow="spill", spilldir=spilldir, maxspills=2)
+        paths = []
+        for i in range(4):
+            self.assertEqual(list(buf.lines(b"long line %d" % i)), [])
+            for line in buf.lines(b"\n"):
+                paths.append(buf.info["spilled"])
+        self.assertEqual(sorted(os.listdir(spilldir)),
+            sorted(os.path.basename(path) for path in paths[2:]))
+        buf.cleanup()
+        self.assertEqual(os.listdir(spilldir), [])
+        os.rmdir(spilldir)
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_write(self):
+        from prociolog import RingBuffer
+
+        ring = RingBuffer(8)
+        ring.write(b"abc")
+        ring.write("def")
+        self.assertEqual((ring.getvalue(), ring.dropped), (b"abcdef", 0))
+        ring.write(memoryview(b"ghij"))
+        self.assertEqual((ring.getvalue(), ring.dropped), (b"cdefghij", 2))
+        ring.write([b"klmnopq", b"rs"])
+        self.assertEqual((ring.getvalue(), ring.dropped), (b"lmnopqrs", 11))
+        self.assertEqual(len(ring), 8)
+        ring.clear()
+        self.assertEqual((ring.getvalue(), len(ring)), (b"", 0))
+
+    def test_lines(self):
+        from prociolog import RingBuffer
+
+        ring = RingBuffer(12, lines=2)
+        ring.write(b"one\ntwo\n")
+        self.assertEqual(ring.getvalue(), b"one\ntwo\n")
+        ring.write(b"three\nfo")
+        self.assertEqual(ring.getvalue(), b"three\nfo")
+        ring.write(b"ur\n")
+        self.assertEqual(ring.getvalue(), b"three\nfour\n")
+        ring.lines = 5
+        ring.write(b"fivesix\n")
+        # The partial line left after data was dropped isn't returned.
+        self.assertEqual(ring.getvalue(), b"fivesix\n")
+
+    def test_size(self):
+        import io
+        from prociolog import LineLoggingFile, RingBuffer
+
+        for size in (0, -1, True):
+            self.assertRaises(ValueError, RingBuffer, size)
+        self.assertEqual(RingBuffer().size, RingBuffer.size)
+
+        # tail=True makes a buffer of the default size, like metrics=True.
+        f = LineLoggingFile(io.BytesIO(), FakeLogger(), tail=True)
+        self.assertIsInstance(f.tail, RingBuffer)
+        self.assertEqual(f.tail.size, RingBuffer.size)
+        f.write(b"x\n")
+        self.assertEqual(f.tail.getvalue(), b"x\n")
+        self.assertRaises(ValueError, LineLoggingFile, io.BytesIO(),
+            FakeLogger(), tail=0)
+
+class TestRuleSet(unittest.TestCase):
+
+    def test_level(self):
+        import re
+        from prociolog import RuleSet
+
+        rules = RuleSet([("Traceback", logging.ERROR), (b"warn(ing)?", logging.WARNING),
+            ("OOM", logging.ERROR)], default=logging.INFO, flags=re.I)
+        self.assertEqual(rules.level(b"all good\n"), logging.INFO)
+        self.assertEqual(rules.level("a Warning\n"), logging.WARNING)
+        # The highest level found in the line wins.
+        self.assertEqual(rules.level(b"warning: oom killer\n"), logging.ERROR)
+        self.assertEqual(rules.level("traceback, then a warning"), logging.ERROR)
+        self.assertEqual(rules.maxlevel, logging.ERROR)
+
+        rules = RuleSet([("ERROR", logging.WARNING)], default=None)
+        self.assertEqual(rules.level(b"debug"), None)
+        self.assertEqual(rules.level(b"ERROR"), logging.WARNING)
+        self.assertEqual(RuleSet([], default=None).level(b"x"), None)
+
+    def test_separate(self):
+        import io
+        import re
+        from prociolog import LineLoggingFile, RuleSet
+
+        # Inline global flags apply to their own pattern only.
+        rules = RuleSet([("(?i)error", logging.WARNING), ("OOM", logging.ERROR)])
+        self.assertEqual(rules.level(b"an Error\n"), logging.WARNING)
+        self.assertEqual(rules.level(b"oom\n"), logging.DEBUG)
+
+        # Group numbers don't shift.
+        rules = RuleSet([("(warn)", logging.WARNING), (r"(x)\1", logging.ERROR)])
+        self.assertEqual(rules.level(b"xx"), logging.ERROR)
+        self.assertEqual(rules.level(b"warn x"), logging.WARNING)
+
+        # Anchors match at the start of each line, not just of a chunk.
+        rules = RuleSet([(r"\Aboom", logging.ERROR)])
+        self.assertEqual(rules.level(b"boom\n"), logging.ERROR)
+        logger, handler = listlogger("tests.rules.separate")
+        loggingfile = LineLoggingFile(io.BytesIO(b"ok\nboom\nno boom\n"), logger,
+            rules=rules)
+        loggingfile.read()
+        self.assertEqual([r.levelno for r in handler.records],
+            [logging.DEBUG, logging.ERROR, logging.DEBUG])
+
+        self.assertRaises(re.error, RuleSet, [("(", logging.ERROR)])
+
+class TestLoggingCmd(unittest.TestCase):
+
+    # Echo stdin to stdout while flooding stderr well past a pipe's capacity.
+    script = (
+        "import sys\n"
+        "sys.stderr.write('e' * 200000)\n"
+        "sys.stderr.flush()\n"
+        "sys.stdout.write(sys.stdin.read())\n"
+    )
+
+    def instance(self, args, cmdclass=None, **kwargs):
+        from prociolog import LoggingCmd
+
+        cmdclass = cmdclass or LoggingCmd
+        logger, handler = listlogger("tests.cmd")
+        for fdname in cmdclass.fdnames:
+            listlogger("tests.cmd." + fdname)
+        return cmdclass(args, logger, **kwargs)
+
+    def records(self, fdname):
+        logger = logging.getLogger("tests.cmd." + fdname)
+        return logger.handlers[0].records
+
+    def test_communicate(self):
+        cmd = self.instance([sys.executable, "-c", self.script])
+        data = b"x" * 100000
+        stdout, stderr = cmd.communicate(data)
+
+        self.assertEqual(cmd.returncode, 0)
+        self.assertEqual(stdout, data)
+        self.assertEqual(stderr, b"e" * 200000)
+        logged = b"".join(r.msg.data for r in self.records("stdout"))
+        self.assertEqual(logged, data)
+        logged = b"".join(r.msg.data for r in self.records("stderr"))
+        self.assertEqual(logged, stderr)
+        self.assertEqual(len(self.records("stdin")), 1)
+
+    def test_pump_streaming(self):
+        cmd = self.instance([sys.executable, "-c", self.script])
+        chunks = [b"foo\n", b"bar\n", b"baz\n"]
+        stdout, stderr = cmd.pump(iter(chunks), collect=False)
+
+        self.assertEqual((stdout, stderr), (None, None))
+        self.assertEqual(cmd.wait(), 0)
+        self.assertEqual([r.msg.data for r in self.records("stdin")], chunks)
+        logged = b"".join(r.msg.data for r in self.records("stdout"))
+        self.assertEqual(logged, b"".join(chunks))
+
+    def test_fdoptions(self):
+        cmd = self.instance([sys.executable, "-c", "pass"],
+            options={"level": 20}, fdoptions={"stdout": {"level": 30}})
+        cmd.communicate()
+        self.assertEqual(cmd.stdin.level, 20)
+        self.assertEqual(cmd.stderr.level, 20)
+        self.assertEqual(cmd.stdout.level, 30)
+
+    def test_policy_per_stream(self):
+        from prociolog import HeadPolicy, LineLoggingFile, LoggingCmd
+
+        class Cmd(LoggingCmd):
+            wrapper = LineLoggingFile
+
+        cmd = self.instance([sys.executable, "-c", "for i in range(10): print(i)"],
+            Cmd, fdoptions={"stdout": {"policy": HeadPolicy(2)}})
+        cmd.communicate()
+
+        self.assertEqual([r.msg.data.strip() for r in self.records("stdout")[:2]],
+            [b"0", b"1"])
+        self.assertEqual(self.records("stdout")[-1].suppressed, 8)
+
+    def test_record_context(self):
+        args = [sys.executable, "-c", "print('out')"]
+        cmd = self.instance(args, options={"extra": {"job": "test"}})
+        cmd.communicate()
+
+        record = self.records("stdout")[0]
+        self.assertEqual(record.pid, cmd.pid)
+        self.assertEqual(record.argv, args)
+        self.assertEqual(record.stream, "stdout")
+        self.assertEqual(record.job, "test")
+        # Records are built without looking up the caller.
+        self.assertEqual(record.lineno, 0)
+        self.assertEqual(record.funcName, "(unknown function)")
+
+    def test_iter_lines(self):
+        from prociolog import LineLoggingFile, LoggingCmd
+
+        class Cmd(LoggingCmd):
+            wrapper = LineLoggingFile
+            options = {"newline": b"\n"}
+
+        cmd = self.instance([sys.executable, "-c", "for i in range(100): print(i)"],
+            Cmd)
+        cmd.stdin.close()
+        lines = [line for line in cmd.stdout]
+        cmd.wait()
+
+        self.assertEqual(len(lines), 100)
+        self.assertEqual([r.msg.data for r in self.records("stdout")], lines)
+
+    def test_tail(self):
+        script = "import sys; sys.stdout.write('x' * 100000); sys.exit(%d)"
+        cmd = self.instance([sys.executable, "-c", script % 0],
+            options={"tail": 1000})
+        cmd.communicate()
+        self.assertEqual(self.records("stdout"), [])
+
+        cmd = self.instance([sys.executable, "-c", script % 3],
+            options={"tail": 1000})
+        stdout, stderr = cmd.communicate()
+        self.assertEqual(cmd.returncode, 3)
+        records = self.records("stdout")
+        self.assertEqual([r.msg.data for r in records], [b"x" * 1000])
+        self.assertEqual(records[0].dropped, 99000)
+        self.assertEqual(records[0].stream, "stdout")
+        self.assertEqual(self.records("stderr"), [])
+        self.assertEqual(cmd.poll(), 3)
+        self.assertEqual(len(self.records("stdout")), 1)
+
+    def test_metrics(self):
+        import tempfile
+        from prociolog import formatmetrics, writemetrics
+
+        cmd = self.instance([sys.executable, "-c", self.script],
+            options={"metrics": True})
+        cmd.communicate(b"x" * 1000)
+
+        pairs = cmd.streammetrics()
+        self.assertEqual([labels["stream"] for labels, metrics in pairs],
+            ["stdin", "stderr", "stdout"])
+        text = formatmetrics(pairs)
+        line = ('prociolog_bytes_total{command="%s",direction="read",pid="%d",'
+            'stream="stdout"} 1000.0' % (sys.executable, cmd.pid))
+        self.assertTrue(line in text.splitlines())
+        self.assertTrue("# TYPE prociolog_read_delay_seconds_max gauge" in text)
+
+        path = os.path.join(tempfile.mkdtemp(), "cmd.prom")
+        writemetrics(path, pairs)
+        with open(path) as f:
+            self.assertEqual(f.read(), formatmetrics(pairs))
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    def test_subscribe(self):
+        import threading
+
+        script = "import sys\nfor i in range(1000): print(i)\nsys.stderr.write('err')"
+        cmd = self.instance([sys.executable, "-c", script])
+        outputs = cmd.subscribe(fdnames=("stdout", "stderr"))
+        everything = cmd.subscribe()
+        chunks = []
+        consumer = threading.Thread(target=lambda: chunks.extend(outputs))
+        consumer.start()
+        stdout, stderr = cmd.communicate()
+        consumer.join()
+
+        self.assertEqual(b"".join(d for s, d in chunks if s == "stdout"), stdout)
+        self.assertEqual(b"".join(d for s, d in chunks if s == "stderr"), stderr)
+        self.assertTrue(outputs.closed and everything.closed)
+        self.assertEqual(list(everything), chunks)
+        self.assertTrue(cmd.subscribe().closed)
+
+    def test_rawio(self):
+        import io
+        from prociolog import LineLoggingFile, LoggingCmd
+
+        class RawCmd(LoggingCmd):
+            wrapper = LineLoggingFile
+            rawio = True
+
+        script = ("import sys\n"
+            "for line in iter(sys.stdin.readline, ''):\n"
+            "    sys.stdout.write(line.upper()); sys.stdout.flush()\n")
+        cmd = self.instance([sys.executable, "-c", script], RawCmd)
+        self.assertTrue(isinstance(cmd.stdout, io.BufferedReader))
+        self.assertTrue(isinstance(cmd.logfile("stdout"), LineLoggingFile))
+        for request in (b"foo\n", b"bar\n"):
+            cmd.stdin.write(request)
+            cmd.stdin.flush()
+            self.assertEqual(cmd.stdout.readline(), request.upper())
+        stdout, stderr = cmd.communicate(b"baz\n")
+
+        self.assertEqual((stdout, stderr), (b"BAZ\n", b""))
+        self.assertEqual([r.getMessage() for r in self.records("stdin")],
+            [repr(b"foo\n"), repr(b"bar\n"), repr(b"baz\n")])
+        self.assertEqual([r.getMessage() for r in self.records("stdout")],
+            [repr(b"FOO\n"), repr(b"BAR\n"), repr(b"BAZ\n")])
+
+    def test_batchtime(self):
+        from prociolog import LineLoggingFile, LoggingCmd
+
+        class BatchCmd(LoggingCmd):
+            wrapper = LineLoggingFile
+            options = {"batchtime": 0.05, "batchlines": 100}
+
+        script = ("import sys, time\n"
+            "print('foo'); sys.stdout.flush(); time.sleep(0.5); print('bar')\n")
+        cmd = self.instance([sys.executable, "-c", script], BatchCmd)
+        cmd.communicate()
+
+        # The first batch was logged while the process was quiet.
+        records = self.records("stdout")
+        self.assertEqual([r.msg.data for r in records], [b"foo\n", b"bar\n"])
+        self.assertTrue(records[1].created - records[0].created > 0.2)
+
+    def test_transcript(self):
+        from prociolog import Transcript
+
+        logger, handler = listlogger("tests.transcript")
+        transcript = Transcript(logger)
+        script = ("import sys\n"
+            "for line in iter(sys.stdin.readline, ''):\n"
+            "    sys.stderr.write('got ' + line); sys.stderr.flush()\n"
+            "    sys.stdout.write(line.upper()); sys.stdout.flush()\n")
+        cmd = self.instance([sys.executable, "-c", script],
+            options={"transcript": transcript, "level": logging.DEBUG - 1})
+        for request in (b"foo\n", b"bar\n"):
+            cmd.stdin.write(request)
+            cmd.stdin.flush()
+            cmd.stdout.readline()
+        cmd.stdin.close()
+        cmd.stderr.read()
+        cmd.wait()
+
+        entries = list(transcript)
+        self.assertEqual([e.seq for e in entries], list(range(len(entries))))
+        self.assertEqual(sorted(e.time for e in entries), [e.time for e in entries])
+        self.assertEqual([e.stream for e in entries],
+            ["stdin", "stdout", "stdin", "stdout", "stderr"])
+        latencies = list(transcript.latencies())
+        self.assertEqual([(r.data, s.data) for r, s, t in latencies],
+            [(b"foo\n", b"FOO\n"), (b"bar\n", b"BAR\n")])
+        self.assertTrue(all(t >= 0 for r, s, t in latencies))
+        # Kept and logged even though the wrappers' level is disabled.
+        self.assertEqual(self.records("stdout"), [])
+        self.assertEqual([r.stream for r in handler.records],
+            [e.stream for e in entries])
+
+    def test_pump_timeout(self):
+        from prociolog import TimeoutExpired
+
+        cmd = self.instance([sys.executable, "-c",
+            "import sys, time; sys.stdout.write('out'); sys.stdout.flush(); "
+            "time.sleep(10)"])
+
+        self.assertRaises(TimeoutExpired, cmd.pump, timeout=0.2)
+        cmd.kill()
+        stdout, stderr = cmd.communicate()
+        self.assertEqual(stdout, b"out")
+        self.assertNotEqual(cmd.returncode, 0)
+
+    def archive(self, cmd, archive):
+        cmd.tees["stdout"].join()
+        archive.seek(0)
+        return archive.read()
+
+    def test_tee(self):
+        import tempfile
+
+        archive = tempfile.TemporaryFile()
+        cmd = self.instance([sys.executable, "-c", self.script],
+            archives={"stdout": archive})
+        data = b"x" * 100000
+        stdout, stderr = cmd.communicate(data)
+
+        self.assertEqual(stdout, data)
+        self.assertEqual(self.archive(cmd, archive), data)
+        records = self.records("stdout")
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].archived, len(data))
+        self.assertEqual(records[0].pid, cmd.pid)
+        self.assertTrue(records[0].finished >= records[0].started)
+        if sys.platform.startswith("linux"):
+            self.assertEqual(records[0].method, "splice")
+        # Other streams are logged as usual.
+        logged = b"".join(r.msg.data for r in self.records("stderr"))
+        self.assertEqual(logged, stderr)
+
+    def test_tee_copy(self):
+        import prociolog
+        import tempfile
+
+        kernelcopy, prociolog._kernelcopy = prociolog._kernelcopy, ()
+        try:
+            archive = tempfile.TemporaryFile()
+            cmd = self.instance([sys.executable, "-c", self.script],
+                archives={"stdout": archive})
+            stdout, stderr = cmd.communicate(b"y" * 100000)
+        finally:
+            prociolog._kernelcopy = kernelcopy
+
+        self.assertEqual(self.archive(cmd, archive), stdout)
+        self.assertEqual(self.records("stdout")[0].method, "copy")
+
+    def test_tee_closed(self):
+        import tempfile
+
+        archive = tempfile.TemporaryFile()
+        cmd = self.instance([sys.executable, "-c", "print('z' * 200000)"],
+            archives={"stdout": archive})
+        cmd.stdout.close()
+        cmd.stdin.close()
+        cmd.stderr.close()
+        cmd.wait()
+
+        self.assertEqual(self.archive(cmd, archive).strip(), b"z" * 200000)
+        self.assertRaises(ValueError, self.instance,
+            [sys.executable, "-c", "pass"], archives={"stdin": archive})
+
+class TestLoggingCmdPool(unittest.TestCase):
+
+    def test_run_many(self):
+        from prociolog import run_many
+
+        logger, handler = listlogger("tests.pool")
+        stdout, _ = listlogger("tests.pool.stdout")
+        script = ("import sys; sys.stdout.write(sys.argv[1] * 3); "
+            "sys.exit(int(sys.argv[1]) % 2)")
+        commands = [[sys.executable, "-c", script, str(i)] for i in range(7)]
+        results = run_many(commands, logger, size=3)
+
+        self.assertEqual(sorted(r.index for r in results), list(range(7)))
+        for result in results:
+            i = result.index
+            self.assertEqual(result.args, commands[i])
+            self.assertEqual(result.stdout, (str(i) * 3).encode("ascii"))
+            self.assertEqual(result.returncode, i % 2)
+            self.assertTrue(result.elapsed >= 0)
+        self.assertEqual(len(stdout.handlers[0].records), 7)
+
+    def test_spawn_error(self):
+        from prociolog import run_many
+
+        logger, handler = listlogger("tests.pool")
+        script = "import sys; sys.stdout.write(sys.stdin.read())"
+        commands = [[sys.executable, "-c", script], ["/nonexistent/command"],
+            [sys.executable, "-c", script]]
+        results = sorted(run_many(commands, logger, input=iter([b"foo", b"bar"])))
+
+        self.assertEqual([r.stdout for r in results], [b"foobar", None, b"foobar"])
+        self.assertEqual([r.returncode for r in results], [0, None, 0])
+        self.assertTrue(isinstance(results[1].error, OSError))
+        self.assertEqual(results[0].error, None)
+
+    def test_close_early(self):
+        from prociolog import LoggingCmd, LoggingCmdPool
+
+        spawned = []
+        class Cmd(LoggingCmd):
+            def __init__(self, *args, **kwargs):
+                LoggingCmd.__init__(self, *args, **kwargs)
+                spawned.append(self)
+
+        class Pool(LoggingCmdPool):
+            cmdclass = Cmd
+
+        logger, handler = listlogger("tests.pool")
+        commands = [[sys.executable, "-c", "import time; time.sleep(30)"]] * 2
+        commands.insert(0, [sys.executable, "-c", "pass"])
+        results = Pool(logger, size=3).run(commands)
+        self.assertEqual(next(results).index, 0)
+        results.close()
+
+        self.assertEqual(len(spawned), 3)
+        for cmd in spawned[1:]:
+            self.assertNotEqual(cmd.returncode, None)
+            self.assertNotEqual(cmd.returncode, 0)
+
+    def test_childlogger(self):
+        from prociolog import childlogger
+
+        logger = logging.getLogger("tests.pool")
+        child = childlogger(logger, "stdout")
+        self.assertTrue(child is logging.getLogger("tests.pool.stdout"))
+        self.assertTrue(childlogger(logger, "stdout") is child)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "capture")
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.dir)
+
+    def record(self, created, pid, stream, data):
+        from prociolog import LazyRepr
+
+        record = logging.LogRecord("tests.capture", logging.DEBUG, "", 0,
+            LazyRepr(data), (), None)
+        record.created = created
+        record.pid = pid
+        record.stream = stream
+        return record
+
+    def test_cmd(self):
+        from prociolog import CaptureHandler, CaptureReader, LoggingCmd
+
+        logger, handler = listlogger("tests.capture")
+        capture = CaptureHandler(self.path)
+        logger.handlers = [capture]
+        script = ("import sys; sys.stdout.write('out' * 1000); "
+            "sys.stdout.flush(); sys.stderr.write('err')")
+        cmd = LoggingCmd([sys.executable, "-c", script], logger)
+        stdout, stderr = cmd.communicate()
+        capture.close()
+
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(reader.read(cmd.pid, "stdout"), stdout)
+            self.assertEqual(reader.read(cmd.pid, "stderr"), b"err")
+            self.assertEqual(reader.read(cmd.pid + 1), b"")
+            offsets = [r.offset for r in reader.records(stream="stdout")]
+            self.assertEqual(offsets[0], 0)
+            self.assertEqual(sorted(offsets), offsets)
+
+    def test_summary(self):
+        from prociolog import CaptureHandler, CaptureReader, LoggingCmd
+
+        logger, handler = listlogger("tests.capture")
+        capture = CaptureHandler(self.path)
+        logger.handlers = [capture, handler]
+        script = "import sys; sys.stdout.write('x' * 20)"
+        cmd = LoggingCmd([sys.executable, "-c", script], logger,
+            options={"maxstream": 5})
+        cmd.communicate()
+        capture.close()
+
+        # The summary of suppressed records isn't stream data.
+        self.assertEqual(handler.records[-1].suppressed, 1)
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(list(reader.records()), [])
+
+    def test_index(self):
+        from prociolog import CaptureHandler, CaptureReader
+
+        capture = CaptureHandler(self.path, indexinterval=100)
+        for i in range(100):
+            stream = ("stdout", "stderr")[i % 2]
+            capture.handle(self.record(1000.0 + i, 42, stream, b"%02d" % i))
+        capture.close()
+
+        with CaptureReader(self.path) as reader:
+            self.assertTrue(len(reader.times) > 10)
+            # The search starts close to the first record in range.
+            self.assertTrue(reader.seek(1050.0) > reader.seek(1010.0) > reader.seek())
+            records = list(reader.records(42, "stderr", 1050.0, 1060.0))
+            self.assertEqual([r.time for r in records],
+                [1051.0, 1053.0, 1055.0, 1057.0, 1059.0])
+            self.assertEqual(reader.read(42, "stderr", 1050.0, 1055.0), b"515355")
+            self.assertEqual([r.offset for r in records], [50, 52, 54, 56, 58])
+
+    def test_partial(self):
+        from prociolog import CaptureHandler, CaptureReader
+
+        capture = CaptureHandler(self.path)
+        capture.handle(self.record(1.0, 1, "stdout", b"complete"))
+        capture.handle(self.record(2.0, 1, "stdout", b"cut short"))
+        capture.close()
+        with open(self.path, "rb+") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(reader.read(), b"complete")
+        with open(self.path, "wb") as f:
+            f.write(b"not a capture")
+        self.assertRaises(ValueError, CaptureReader, self.path)
+
+    def test_archive(self):
+        import gzip
+        import mmap
+        from prociolog import ArchiveHandler, ArchiveReader, CaptureReader, LoggingCmd
+
+        logger, handler = listlogger("tests.capture")
+        archive = ArchiveHandler(self.path)
+        logger.handlers = [archive]
+        script = ("import sys; sys.stdout.write('out' * 10000); "
+            "sys.stdout.flush(); sys.stderr.write('err')")
+        cmd = LoggingCmd([sys.executable, "-c", script], logger)
+        stdout, stderr = cmd.communicate()
+        archive.close()
+
+        self.assertTrue(os.path.getsize(self.path) < len(stdout) // 10)
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(reader.compression, "gzip")
+            self.assertTrue(isinstance(reader.map, mmap.mmap))
+            self.assertEqual(reader.read(cmd.pid, "stdout"), stdout)
+            self.assertEqual(reader.read(cmd.pid, "stderr"), b"err")
+
+        # Decompressed, an archive is a capture file.
+        with gzip.open(self.path) as f:
+            data = f.read()
+        with open(self.path + ".capture", "wb") as f:
+            f.write(data)
+        with CaptureReader(self.path + ".capture") as reader:
+            self.assertEqual(reader.read(cmd.pid, "stdout"), stdout)
+
+    def test_archive_frames(self):
+        from prociolog import ArchiveHandler, ArchiveReader
+
+        archive = ArchiveHandler(self.path, framesize=100)
+        for i in range(50):
+            archive.handle(self.record(1000.0 + i, 42, "stdout", b"%02d" % i))
+        archive.close()
+        archive = ArchiveHandler(self.path, framesize=100)
+        for i in range(50, 100):
+            archive.handle(self.record(1000.0 + i, 42, "stdout", b"%02d" % i))
+        archive.close()
+        self.assertEqual(archive.errors, 0)
+
+        with ArchiveReader(self.path) as reader:
+            self.assertTrue(len(reader.times) > 10)
+            self.assertEqual(len(list(reader.frames())), len(reader.positions))
+            self.assertTrue(reader.seek(1050.0) > reader.seek(1010.0) > reader.seek())
+            self.assertEqual(reader.read(42, "stdout", 1050.0, 1055.0), b"505152535455")
+            self.assertEqual(reader.read(),
+                b"".join(b"%02d" % i for i in range(100)))
+
+        with open(self.path, "rb+") as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        with ArchiveReader(self.path) as reader:
+            data = reader.read()
+            self.assertEqual(data, b"".join(b"%02d" % i for i in range(len(data) // 2)))
+            self.assertTrue(len(data) > 150)
+        with open(self.path, "wb") as f:
+            f.write(b"not an archive")
+        self.assertRaises(ValueError, ArchiveReader, self.path)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_archive_zstd(self):
+        from prociolog import ArchiveHandler, ArchiveReader
+
+        archive = ArchiveHandler(self.path, compression="zstd", framesize=100)
+        for i in range(50):
+            archive.handle(self.record(1000.0 + i, 42, "stdout", b"%02d" % i))
+        archive.close()
+
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(reader.compression, "zstd")
+            self.assertEqual(reader.read(42, "stdout", 1010.0, 1012.0), b"101112")
+
+class TestSubscription(unittest.TestCase):
+
+    def test_cancelled(self):
+        from prociolog import Subscription
+
+        loop = asyncio.new_event_loop()
+        subscription = Subscription()
+
+        async def consume():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(subscription.__anext__(), 0.01)
+            subscription.put("stdout", b"first")
+            subscription.put("stdout", b"second")
+            return [await subscription.__anext__(), await subscription.__anext__()]
+
+        try:
+            self.assertEqual(loop.run_until_complete(consume()),
+                [("stdout", b"first"), ("stdout", b"second")])
+            # A chunk handed to a waiter that gave up goes back on the queue.
+            future = loop.create_future()
+            future.cancel()
+            subscription.deliver(future, ("stdout", b"late"))
+        finally:
+            loop.close()
+        self.assertEqual(subscription.get(0), ("stdout", b"late"))
+        self.assertEqual((subscription.received, subscription.dropped), (2, 0))
+        self.assertEqual(len(subscription.waiters), 0)
+
+class TestAsyncLoggingCmd(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def instance(self, args):
+        from prociolog import AsyncLoggingCmd
+
+        logger, handler = listlogger("tests.async")
+        for fdname in AsyncLoggingCmd.fdnames:
+            listlogger("tests.async." + fdname)
+        return self.loop.run_until_complete(AsyncLoggingCmd.create(args, logger))
+
+    def records(self, fdname):
+        logger = logging.getLogger("tests.async." + fdname)
+        return logger.handlers[0].records
+
+    def test_communicate(self):
+        cmd = self.instance([sys.executable, "-c", TestLoggingCmd.script])
+        data = b"x" * 100000
+        stdout, stderr = self.loop.run_until_complete(cmd.communicate(data))
+
+        self.assertEqual(cmd.returncode, 0)
+        self.assertEqual(stdout, data)
+        self.assertEqual(stderr, b"e" * 200000)
+        self.assertEqual([r.msg.data for r in self.records("stdin")], [data])
+        logged = b"".join(r.msg.data for r in self.records("stdout"))
+        self.assertEqual(logged, data)
+
+    def test_subscribe(self):
+        cmd = self.instance([sys.executable, "-c", "print('foo')"])
+        subscription = cmd.subscribe(fdnames=["stdout"])
+        # The consumer is waiting before any data arrives.
+        first, (stdout, stderr) = self.loop.run_until_complete(asyncio.gather(
+            subscription.__anext__(), cmd.communicate()))
+        self.assertEqual(first, ("stdout", stdout))
+        self.assertTrue(subscription.closed)
+        self.assertRaises(StopAsyncIteration, self.loop.run_until_complete,
+            subscription.__anext__())
+
+    def test_record_context(self):
+        args = [sys.executable, "-c", "print('out')"]
+        cmd = self.instance(args)
+        self.loop.run_until_complete(cmd.communicate())
+
+        record = self.records("stdout")[0]
+        self.assertEqual(record.pid, cmd.process.pid)
+        self.assertEqual(record.argv, args)
+        self.assertEqual(record.stream, "stdout")
+        self.assertIsNot(cmd.stdout, cmd.process.stdout)
+        self.assertIs(cmd.logfile("stdout"), cmd.stdout)
+
+    def test_policy(self):
+        from prociolog import AsyncLoggingCmd, HeadPolicy
+
+        logger, _ = listlogger("tests.async")
+        _, handler = listlogger("tests.async.stdout")
+        script = "import sys; sys.stdout.write('foo'); sys.stdout.flush(); print('bar')"
+        cmd = self.loop.run_until_complete(AsyncLoggingCmd.create(
+            [sys.executable, "-c", script], logger,
+            fdoptions={"stdout": {"policy": HeadPolicy(1), "metrics": True}}))
+        self.loop.run_until_complete(cmd.stdout.readexactly(3))
+        self.loop.run_until_complete(cmd.communicate())
+
+        # The stream was finished at EOF, without being closed.
+        self.assertEqual(handler.records[-1].suppressed, 1)
+        self.assertTrue(cmd.stdout.finished)
+        cmd.stdout.close()
+        self.assertEqual(len(handler.records), 2)
+
+    def test_readline(self):
+        cmd = self.instance([sys.executable, "-c", "print('foo'); print('bar')"])
+        line = self.loop.run_until_complete(cmd.stdout.readline())
+        self.assertEqual(line.strip(), b"foo")
+        self.assertEqual(self.loop.run_until_complete(cmd.wait()), 0)
+
+        records = self.records("stdout")
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].msg.data, line)
+
+    def test_iter(self):
+        cmd = self.instance([sys.executable, "-c", "print('foo'); print('bar')"])
+
+        async def lines():
+            return [line async for line in cmd.stdout]
+
+        self.assertEqual(self.loop.run_until_complete(lines()), [b"foo\n", b"bar\n"])
+        self.assertEqual(self.loop.run_until_complete(cmd.wait()), 0)
+        self.assertTrue(cmd.stdout.finished)
+        self.assertEqual(b"".join(r.msg.data for r in self.records("stdout")),
+            b"foo\nbar\n")
+
 
 if __name__ == "__main__":
     unittest.main()